@@ -1,23 +1,29 @@
+import os
 from flask import Flask
-from flask.ext.sqlalchemy import SQLAlchemy
 from flask.ext.login import LoginManager
 from config import basedir, ADMINS, MAIL_SERVER, MAIL_PORT, MAIL_USERNAME,\
-    MAIL_PASSWORD
+    MAIL_PASSWORD, TEMPLATE_CACHE_DIR
+from jinja2 import FileSystemBytecodeCache
 from flask.ext.mail import Mail
 from .momentjs import momentjs
+from .database import Database
 
 
 app = Flask(__name__)
 app.config.from_object('config')
-db = SQLAlchemy(app)
+db = Database(app)
 lm = LoginManager()
 lm.init_app(app)
 lm.login_view = 'login'
 mail = Mail(app)
 app.jinja_env.globals['momentjs'] = momentjs
+# compiled templates are shared between worker processes and restarts
+os.makedirs(TEMPLATE_CACHE_DIR, exist_ok=True)
+app.jinja_env.bytecode_cache = FileSystemBytecodeCache(TEMPLATE_CACHE_DIR)
 
 
-from app import views, models
+from app import views, models, search, fragments, api, metrics, profiler, \
+    slowquery
 
 
 if not app.debug:
@@ -0,0 +1,156 @@
+import json
+import threading
+from contextlib import ExitStack
+from functools import wraps
+from flask import g, jsonify, request, Response, stream_with_context
+from app import app, db
+from config import API_PAGE_SIZE, API_MAX_PAGE_SIZE, API_STREAM_CHUNK, \
+    API_MAX_STREAMS
+from .models import User, Post
+from .pagination import paginate, fetch, decode_cursor
+from .search import search_posts
+from .decorators import read_only
+
+POST_FIELDS = {
+    'id': lambda post: post.id,
+    'body': lambda post: post.body,
+    'timestamp': lambda post: post.timestamp.strftime('%Y-%m-%dT%H:%M:%SZ'),
+    'author': lambda post: post.author.username,
+    'avatar': lambda post: post.author.avatar(70),
+}
+DEFAULT_FIELDS = ['id', 'body', 'timestamp', 'author']
+
+# a stream keeps its pooled database connection until it ends
+streams = threading.BoundedSemaphore(API_MAX_STREAMS)
+
+
+class APIError(Exception):
+
+    def __init__(self, status, message):
+        Exception.__init__(self, message)
+        self.status = status
+        self.message = message
+
+
+@app.errorhandler(APIError)
+def api_error(error):
+    response = jsonify(error=error.message)
+    response.status_code = error.status
+    return response
+
+
+def api_login_required(f):
+    # like login_required, but answers 401 instead of redirecting to a form
+    @wraps(f)
+    def wrapper(*args, **kwargs):
+        if not g.user.is_authenticated:
+            raise APIError(401, 'authentication required')
+        return f(*args, **kwargs)
+    return wrapper
+
+
+def requested_fields():
+    fields = request.args.get('fields')
+    if not fields:
+        return DEFAULT_FIELDS
+    names = [name.strip() for name in fields.split(',') if name.strip()]
+    unknown = [name for name in names if name not in POST_FIELDS]
+    if unknown:
+        raise APIError(400, 'unknown fields: ' + ', '.join(unknown))
+    return names
+
+
+def page_size():
+    size = request.args.get('limit', API_PAGE_SIZE, type=int)
+    return max(1, min(size, API_MAX_PAGE_SIZE))
+
+
+def post_json(post, fields):
+    return dict((name, POST_FIELDS[name](post)) for name in fields)
+
+
+def ndjson(posts, fields):
+    # The posts are read while the response is sent, after the view (and
+    # its read_only()) has returned, so generate() re-enters replica_reads()
+    # itself when the view was reading from the replica.
+    if not streams.acquire(blocking=False):
+        raise APIError(503, 'too many streams, try again later')
+    replica = db.session().use_replica
+
+    def generate():
+        with ExitStack() as stack:
+            if replica:
+                stack.enter_context(db.replica_reads())
+            for post in posts:
+                yield json.dumps(post_json(post, fields)) + '\n'
+    response = Response(stream_with_context(generate()),
+                        mimetype='application/x-ndjson')
+    response.call_on_close(streams.release)
+    return response
+
+
+def stream(query, cursor):
+    # API_STREAM_CHUNK posts at a time, each chunk a keyset range read
+    while True:
+        posts = fetch(query, API_STREAM_CHUNK, cursor)
+        for post in posts:
+            yield post
+        if len(posts) < API_STREAM_CHUNK:
+            return
+        cursor = (posts[-1].timestamp, posts[-1].id)
+
+
+def post_listing(query):
+    fields = requested_fields()
+    before = request.args.get('before')
+    if request.args.get('stream'):
+        return ndjson(stream(query, decode_cursor(before)), fields)
+    page = paginate(query, page_size(), before=before,
+                    after=request.args.get('after'))
+    return jsonify(posts=[post_json(post, fields) for post in page.items],
+                   before=page.next_cursor if page.has_next else None,
+                   after=page.prev_cursor if page.has_prev else None)
+
+
+@app.route('/api/v1/timeline')
+@api_login_required
+@read_only
+def api_timeline():
+    return post_listing(g.user.followed_posts())
+
+
+@app.route('/api/v1/users/<username>/posts')
+@api_login_required
+@read_only
+def api_user_posts(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        raise APIError(404, 'user %s not found' % username)
+    return post_listing(Post.query.options(Post.load_authors())
+                        .filter(Post.user_id == user.id))
+
+
+@app.route('/api/v1/search')
+@api_login_required
+@read_only
+def api_search():
+    query = request.args.get('q')
+    if not query:
+        raise APIError(400, 'missing q')
+    fields = requested_fields()
+    if request.args.get('stream'):
+        def posts():
+            page = 1
+            while True:
+                results = search_posts(query, page, API_STREAM_CHUNK)
+                for post in results.items:
+                    yield post
+                if not results.has_next:
+                    break
+                page += 1
+        return ndjson(posts(), fields)
+    page = max(request.args.get('page', 1, type=int), 1)
+    results = search_posts(query, page, page_size())
+    return jsonify(posts=[post_json(post, fields) for post in results.items],
+                   page=page, has_next=results.has_next,
+                   total=results.total)
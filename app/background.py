@@ -0,0 +1,50 @@
+import atexit
+import os
+import threading
+from app import app
+
+
+class Flusher(object):
+    # Calls `func` from a daemon thread every `interval` seconds, sooner when
+    # woken, and once more when the interpreter exits unless `at_exit` is
+    # off. The thread is only started on first use, and started again in a
+    # forked child, so that forked workers each get their own.
+
+    def __init__(self, func, interval, at_exit=True):
+        self.func = func
+        self.interval = interval
+        self.at_exit = at_exit
+        self._wakeup = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def start(self):
+        pid = os.getpid()
+        if self._pid == pid:
+            return
+        with self._lock:
+            if self._pid == pid:
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+            if self.at_exit and self._pid is None:
+                # atexit handlers are inherited across fork
+                atexit.register(self.run_once)
+            self._pid = pid
+
+    def wake(self):
+        self._wakeup.set()
+
+    def run_once(self):
+        try:
+            self.func()
+        except Exception:
+            app.logger.exception('background flush failed')
+
+    def _run(self):
+        while True:
+            self._wakeup.wait(self.interval)
+            self._wakeup.clear()
+            self.run_once()
@@ -0,0 +1,91 @@
+import time
+import sqlite3
+from contextlib import contextmanager
+from flask import current_app, has_request_context, session as flask_session
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.sql.expression import UpdateBase
+from flask.ext.sqlalchemy import SQLAlchemy, SignallingSession, get_state
+
+
+def apply_sqlite_pragmas(connection, config):
+    cursor = connection.cursor()
+    cursor.execute('PRAGMA journal_mode=%s' % config['SQLITE_JOURNAL_MODE'])
+    cursor.execute('PRAGMA synchronous=%s' % config['SQLITE_SYNCHRONOUS'])
+    cursor.execute('PRAGMA mmap_size=%d' % config['SQLITE_MMAP_SIZE'])
+    cursor.execute('PRAGMA busy_timeout=%d' % config['SQLITE_BUSY_TIMEOUT'])
+    cursor.close()
+
+
+def sqlite_connector(path, config):
+    def connect():
+        connection = sqlite3.connect(
+            path, timeout=config['SQLITE_BUSY_TIMEOUT'] / 1000.0,
+            check_same_thread=False)
+        apply_sqlite_pragmas(connection, config)
+        return connection
+    return connect
+
+
+class RoutingSession(SignallingSession):
+    # Inside replica_reads() queries go to the 'replica' bind, until the
+    # session flushes a change or executes an INSERT, UPDATE or DELETE
+    # statement; from then on everything it reads comes from the primary so
+    # a request always sees its own writes.
+
+    def __init__(self, *args, **kwargs):
+        SignallingSession.__init__(self, *args, **kwargs)
+        self.use_replica = False
+        self.wrote = False
+
+    def get_bind(self, mapper=None, clause=None):
+        if isinstance(clause, UpdateBase):
+            self.wrote = True
+        if self.use_replica and not self.wrote and \
+                'replica' in (self.app.config['SQLALCHEMY_BINDS'] or {}):
+            return get_state(self.app).db.get_engine(self.app, bind='replica')
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+@event.listens_for(RoutingSession, 'before_flush')
+def route_to_primary(session, flush_context, instances):
+    session.wrote = True
+
+
+@event.listens_for(RoutingSession, 'after_commit')
+def stick_to_primary(session):
+    # the page a write redirects to is read from the primary as well, the
+    # replica may not have caught up yet
+    if session.wrote and has_request_context():
+        flask_session['primary_until'] = \
+            time.time() + current_app.config['REPLICA_STICKY_WINDOW']
+
+
+class Database(SQLAlchemy):
+    # Opens file based SQLite databases with the SQLITE_* pragmas applied to
+    # every connection and keeps them in a pool, where SQLAlchemy would
+    # otherwise open a fresh connection for each checkout.
+
+    def apply_driver_hacks(self, app, info, options):
+        SQLAlchemy.apply_driver_hacks(self, app, info, options)
+        if info.drivername != 'sqlite' or \
+                info.database in (None, '', ':memory:'):
+            return
+        options['creator'] = sqlite_connector(info.database, app.config)
+        options['poolclass'] = QueuePool
+        options['pool_size'] = app.config['SQLITE_POOL_SIZE']
+        options['max_overflow'] = app.config['SQLITE_POOL_OVERFLOW']
+        options['pool_timeout'] = app.config['SQLITE_POOL_TIMEOUT']
+
+    def create_session(self, options):
+        return RoutingSession(self, **options)
+
+    @contextmanager
+    def replica_reads(self):
+        session = self.session()
+        use_replica = session.use_replica
+        session.use_replica = True
+        try:
+            yield
+        finally:
+            session.use_replica = use_replica
@@ -1,8 +1,49 @@
-from threading import Thread
+import time
+from functools import wraps
+from hashlib import md5
+from flask import request, session, make_response
+from app import db
 
 
-def async(f):
+def page_etag(*parts):
+    return md5('|'.join(str(part) for part in parts).encode('utf-8')) \
+        .hexdigest()
+
+
+def conditional(version):
+    # `version` is called with the view's arguments and returns a weak ETag
+    # (or None). A GET that already has that version gets a 304 without the
+    # view running at all. There is no Last-Modified: the ETags also cover
+    # follows, profile edits and the CSRF window, which a date can't.
+    def decorator(f):
+        @wraps(f)
+        def wrapper(*args, **kwargs):
+            if request.method not in ('GET', 'HEAD') or \
+                    session.get('_flashes'):
+                return f(*args, **kwargs)
+            etag = version(*args, **kwargs)
+            if etag is None:
+                return f(*args, **kwargs)
+            if request.if_none_match.contains_weak(etag):
+                response = make_response('', 304)
+            else:
+                response = make_response(f(*args, **kwargs))
+            response.set_etag(etag, weak=True)
+            response.cache_control.private = True
+            response.cache_control.no_cache = True
+            return response
+        return wrapper
+    return decorator
+
+
+def read_only(f):
+    # GET requests to the view read from the replica, unless this visitor
+    # wrote something moments ago
+    @wraps(f)
     def wrapper(*args, **kwargs):
-        thr = Thread(target=f, args=args, kwargs=kwargs)
-        thr.start()
+        if request.method not in ('GET', 'HEAD') or \
+                session.get('primary_until', 0) > time.time():
+            return f(*args, **kwargs)
+        with db.replica_reads():
+            return f(*args, **kwargs)
     return wrapper
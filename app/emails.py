@@ -1,28 +1,97 @@
+import atexit
+import threading
+from collections import OrderedDict
 from flask.ext.mail import Message
-from app import mail, app
-from flask import render_template
-from config import ADMINS
-from .decorators import async
-
-
-@async
-def send_async_email(app, msg):
-    with app.app_context():
-        mail.send(msg)
+from app import app
+from flask import render_template, request
+from config import ADMINS, FOLLOW_DIGEST_WINDOW, FOLLOW_DIGEST_NAMES, \
+    MAIL_EXIT_TIMEOUT
+from .background import Flusher
+from .mailer import mail_dispatcher
+from .models import User
 
 
 def send_email(subject, sender, recipients, text_body, html_body):
     msg = Message(subject, sender=sender, recipients=recipients)
     msg.body = text_body
     msg.html = html_body
-    send_async_email(app, msg)
+    mail_dispatcher.start()
+    mail_dispatcher.submit(msg)
+
+
+def follower_names(followers, others):
+    names = [follower.username for follower in followers]
+    if others:
+        return '%s and %d other%s' % (', '.join(names), others,
+                                      '' if others == 1 else 's')
+    if len(names) == 1:
+        return names[0]
+    return '%s and %s' % (', '.join(names[:-1]), names[-1])
+
+
+class FollowDigest(object):
+    # Collects follow events per followed user and sends each of them a
+    # single email per `window` seconds listing everyone who followed them,
+    # rendered on the flusher thread instead of in the follow request.
+
+    def __init__(self, window):
+        # followed id -> (url root, follower ids)
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flusher = Flusher(self.flush, window, at_exit=False)
+        atexit.register(self.close)
+
+    def record(self, followed, follower):
+        with self._lock:
+            url_root, follower_ids = self._pending.setdefault(
+                followed.id, (request.url_root, []))
+            if follower.id not in follower_ids:
+                follower_ids.append(follower.id)
+        self._flusher.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, OrderedDict()
+        for followed_id, (url_root, follower_ids) in pending.items():
+            # a request context so the templates can build external links
+            with app.test_request_context(base_url=url_root):
+                try:
+                    self._send(followed_id, follower_ids)
+                except Exception:
+                    # the rest of the window's digests still go out
+                    app.logger.exception('could not send the follow digest '
+                                         'for user %d', followed_id)
+
+    def close(self):
+        # The mail workers are daemon threads: give the last digests up to
+        # MAIL_EXIT_TIMEOUT seconds to be sent before the interpreter exits.
+        self._flusher.run_once()
+        if not mail_dispatcher.join(MAIL_EXIT_TIMEOUT):
+            app.logger.warning('exiting with %d emails unsent',
+                               mail_dispatcher.queue.unfinished_tasks)
+
+    def _send(self, followed_id, follower_ids):
+        user = User.query.get(followed_id)
+        found = dict((follower.id, follower) for follower in
+                     User.query.filter(User.id.in_(follower_ids)))
+        followers = [found[id] for id in follower_ids if id in found]
+        if user is None or not followers:
+            return
+        shown = followers[:FOLLOW_DIGEST_NAMES]
+        others = len(followers) - len(shown)
+        send_email("[microblog] %s %s now following you!" %
+                   (follower_names(shown, others),
+                    'is' if len(followers) == 1 else 'are'),
+                   ADMINS[0],
+                   [user.email],
+                   render_template("follower_email.txt", user=user,
+                                   followers=shown, others=others),
+                   render_template("follower_email.html", user=user,
+                                   followers=shown, others=others))
+
+
+follow_digest = FollowDigest(FOLLOW_DIGEST_WINDOW)
 
 
 def follower_notification(followed, follower):
-    send_email("[microblog] %s is now following you!" % follower.username,
-               ADMINS[0],
-               [followed.email],
-               render_template("follower_email.txt",
-                               user=followed, follower=follower),
-               render_template("follower_email.html",
-                               user=followed, follower=follower))
+    follow_digest.record(followed, follower)
@@ -2,6 +2,7 @@ from flask.ext.wtf import Form
 from wtforms import StringField, BooleanField, PasswordField, SubmitField, \
     TextAreaField
 from wtforms.validators import DataRequired, Length, Optional
+from app import db
 from .models import User
 
 
@@ -18,7 +19,9 @@ class LoginForm(Form):
     def validate(self):
         if not Form.validate(self):
             return False
-        user = User.query.filter_by(email=self.email.data.lower()).first()
+        with db.replica_reads():
+            user = User.query.filter_by(email=self.email.data.lower()) \
+                .first()
         if user is None:
             self.email.errors.append("No such email")
             return False
@@ -42,7 +45,9 @@ class SignupForm(Form):
     def validate(self):
         if not Form.validate(self):
             return False
-        user = User.query.filter_by(email=self.email.data.lower()).first()
+        with db.replica_reads():
+            user = User.query.filter_by(email=self.email.data.lower()) \
+                .first()
         if user:
             self.email.errors.append("There is already an account with \
                                           this email.")
@@ -64,12 +69,15 @@ class EditForm(Form):
     def validate(self):
         if not Form.validate(self):
             return False
-        user_name = User.query.filter_by(username=self.username.data).first()
+        with db.replica_reads():
+            user_name = User.query.filter_by(username=self.username.data) \
+                .first()
         if user_name:
             self.username.errors.append('This username is already in use.\
                                         Please choose another one.')
             return False
-        user_email = User.query.filter_by(email=self.email.data).first()
+        with db.replica_reads():
+            user_email = User.query.filter_by(email=self.email.data).first()
         if user_email:
             self.email.errors.append('This email is already in use.\
                                         Please choose another one.')
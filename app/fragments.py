@@ -0,0 +1,75 @@
+from hashlib import md5
+from flask import render_template
+from jinja2 import Markup
+from app import app
+from config import FRAGMENT_CACHE_BACKEND, FRAGMENT_CACHE_SIZE, \
+    FRAGMENT_CACHE_TTL, FRAGMENT_CACHE_SERVERS
+from .cache import LRUCache
+from .momentjs import now_bucket
+
+
+class LocalBackend(object):
+    # The subset of the werkzeug cache interface PostFragments uses, backed
+    # by an in-process LRU.
+
+    def __init__(self, maxsize, ttl):
+        self.cache = LRUCache(maxsize, ttl)
+
+    def get_many(self, *keys):
+        return [self.cache.get(key) for key in keys]
+
+    def set(self, key, value):
+        self.cache.set(key, value)
+        return True
+
+    def clear(self):
+        self.cache.clear()
+        return True
+
+
+def make_backend(name):
+    if name == 'local':
+        return LocalBackend(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL)
+    from werkzeug.contrib import cache
+    if name == 'simple':  # werkzeug's in-process cache, used in tests
+        return cache.SimpleCache(FRAGMENT_CACHE_SIZE, FRAGMENT_CACHE_TTL)
+    if name == 'memcached':
+        return cache.MemcachedCache(FRAGMENT_CACHE_SERVERS,
+                                    FRAGMENT_CACHE_TTL, 'microblog:')
+    raise ValueError('unknown fragment cache backend %r' % name)
+
+
+def author_version(author):
+    # Changes whenever edit() changes what post.html shows of the author
+    # (name and avatar), which retires every fragment cached for them.
+    fields = '%s|%s' % (author.username, author.email_hash)
+    return md5(fields.encode('utf-8')).hexdigest()[:12]
+
+
+class PostFragments(object):
+    # Rendered post.html per (post id, author version, NOW_BUCKET). Post
+    # bodies never change, but the "said ... ago" time in them does, so a
+    # cached fragment goes stale with its author or the next time bucket.
+
+    def __init__(self, backend):
+        self.backend = backend
+
+    def key(self, post, bucket):
+        return 'post:%d:%s:%s' % (post.id, author_version(post.author),
+                                  bucket.strftime('%Y%m%d%H%M%S'))
+
+    def render(self, posts):
+        bucket = now_bucket()
+        keys = [self.key(post, bucket) for post in posts]
+        cached = self.backend.get_many(*keys) if keys else []
+        fragments = []
+        for post, key, html in zip(posts, keys, cached):
+            if html is None:
+                html = render_template('post.html', post=post)
+                self.backend.set(key, html)
+            fragments.append((post, Markup(html)))
+        return fragments
+
+
+post_fragments = PostFragments(make_backend(FRAGMENT_CACHE_BACKEND))
+app.jinja_env.globals['render_posts'] = post_fragments.render
@@ -0,0 +1,46 @@
+import threading
+from datetime import datetime
+from app import db
+from config import LAST_SEEN_FLUSH_INTERVAL, LAST_SEEN_THROTTLE
+from .background import Flusher
+from .models import User
+
+
+class LastSeenBuffer(object):
+    # Collects last_seen updates in memory (last write wins per user) and
+    # writes them out in one bulk UPDATE, so read-only requests don't need a
+    # write transaction of their own.
+
+    def __init__(self, interval, throttle):
+        self.throttle = throttle
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._flusher = Flusher(self.flush, interval)
+
+    def touch(self, user, when=None):
+        if when is None:
+            when = datetime.utcnow()
+        if user.last_seen is not None and \
+                when - user.last_seen < self.throttle:
+            return
+        with self._lock:
+            self._pending[user.id] = when
+        self._flusher.start()
+
+    def flush(self):
+        with self._lock:
+            pending, self._pending = self._pending, {}
+        if not pending:
+            return
+        table = User.__table__
+        stmt = table.update() \
+            .where(table.c.id == db.bindparam('user_id')) \
+            .where(db.or_(table.c.last_seen == None,  # noqa: E711
+                          table.c.last_seen < db.bindparam('seen'))) \
+            .values(last_seen=db.bindparam('seen'))
+        with db.engine.begin() as connection:
+            connection.execute(stmt, [{'user_id': id, 'seen': when}
+                                      for id, when in pending.items()])
+
+
+last_seen_buffer = LastSeenBuffer(LAST_SEEN_FLUSH_INTERVAL, LAST_SEEN_THROTTLE)
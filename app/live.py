@@ -0,0 +1,104 @@
+import json
+import threading
+from queue import Queue, Empty, Full
+from config import LIVE_BACKEND, LIVE_REDIS_URL, LIVE_QUEUE_SIZE
+
+
+class LocalSubscription(object):
+
+    def __init__(self, pubsub, topics):
+        self.pubsub = pubsub
+        self.topics = topics
+        self.queue = Queue(LIVE_QUEUE_SIZE)
+
+    def get(self, timeout):
+        try:
+            return self.queue.get(timeout=timeout)
+        except Empty:
+            return None
+
+    def close(self):
+        self.pubsub.unsubscribe(self)
+
+
+class LocalPubSub(object):
+    # Publish/subscribe between requests of a single process. A subscriber
+    # that falls LIVE_QUEUE_SIZE messages behind misses the rest rather than
+    # slowing down the publisher.
+
+    def __init__(self):
+        self._subscribers = {}  # topic -> set of subscriptions
+        self._lock = threading.Lock()
+
+    def subscribe(self, topics):
+        subscription = LocalSubscription(self, topics)
+        with self._lock:
+            for topic in topics:
+                self._subscribers.setdefault(topic, set()).add(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            for topic in subscription.topics:
+                subscribers = self._subscribers.get(topic)
+                if subscribers is not None:
+                    subscribers.discard(subscription)
+                    if not subscribers:
+                        del self._subscribers[topic]
+
+    def publish(self, topic, message):
+        with self._lock:
+            subscribers = list(self._subscribers.get(topic, ()))
+        for subscription in subscribers:
+            try:
+                subscription.queue.put_nowait(message)
+            except Full:
+                pass
+
+
+class RedisSubscription(object):
+
+    def __init__(self, pubsub):
+        self.pubsub = pubsub
+
+    def get(self, timeout):
+        message = self.pubsub.get_message(timeout=timeout)
+        if message is None:
+            return None
+        return json.loads(message['data'].decode('utf-8'))
+
+    def close(self):
+        self.pubsub.close()
+
+
+class RedisPubSub(object):
+    # Publish/subscribe through Redis channels, for deployments that run
+    # more than one process.
+
+    def __init__(self, url):
+        import redis
+        self.redis = redis.StrictRedis.from_url(url)
+
+    def channel(self, topic):
+        return 'microblog:live:%s' % topic
+
+    def subscribe(self, topics):
+        pubsub = self.redis.pubsub(ignore_subscribe_messages=True)
+        if topics:
+            pubsub.subscribe(*[self.channel(topic) for topic in topics])
+        return RedisSubscription(pubsub)
+
+    def publish(self, topic, message):
+        self.redis.publish(self.channel(topic), json.dumps(message))
+
+
+def make_pubsub(name):
+    if name == 'local':
+        return LocalPubSub()
+    if name == 'redis':
+        return RedisPubSub(LIVE_REDIS_URL)
+    raise ValueError('unknown live update backend %r' % name)
+
+
+# new posts, published under their author's id
+live_posts = make_pubsub(LIVE_BACKEND)
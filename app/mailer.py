@@ -0,0 +1,190 @@
+import json
+import smtplib
+import threading
+import time
+import uuid
+from datetime import datetime
+from queue import Queue, Empty, Full
+from flask.ext.mail import Message
+from app import app, db, mail
+from config import MAIL_WORKERS, MAIL_QUEUE_SIZE, MAIL_QUEUE_TIMEOUT, \
+    MAIL_BATCH_SIZE, MAIL_OUTBOX, MAIL_OUTBOX_CLAIM_TIMEOUT
+from .background import Flusher
+from .models import OutboxMessage
+
+
+def message_to_json(msg):
+    return json.dumps({'subject': msg.subject,
+                       'sender': msg.sender,
+                       'recipients': msg.recipients,
+                       'body': msg.body,
+                       'html': msg.html})
+
+
+def message_from_json(payload):
+    fields = json.loads(payload)
+    return Message(fields['subject'], sender=fields['sender'],
+                   recipients=fields['recipients'], body=fields['body'],
+                   html=fields['html'])
+
+
+class MailDispatcher(object):
+    # Sends mail from a fixed pool of worker threads fed by a bounded queue.
+    # Each worker drains up to `batch_size` queued messages over a single
+    # SMTP connection. With `outbox` set, messages are also kept in the
+    # outbox table until sent; messages a batch failed to send are released
+    # there. Twice per MAIL_OUTBOX_CLAIM_TIMEOUT the dispatcher renews its
+    # claim on the messages it holds and picks up the released ones and
+    # those a dead process left behind.
+
+    def __init__(self, app, workers, queue_size, batch_size, outbox=False):
+        self.app = app
+        self.workers = workers
+        self.batch_size = batch_size
+        self.outbox = outbox
+        self.queue = Queue(queue_size)
+        self.token = uuid.uuid4().hex
+        self._threads = []
+        self._lock = threading.Lock()
+        self._reclaimer = Flusher(
+            self._reclaim, MAIL_OUTBOX_CLAIM_TIMEOUT.total_seconds() / 2,
+            at_exit=False)
+
+    def start(self):
+        if self._threads:
+            return
+        with self._lock:
+            if self._threads:
+                return
+            for i in range(self.workers):
+                thread = threading.Thread(target=self._work)
+                thread.daemon = True
+                thread.start()
+                self._threads.append(thread)
+        if self.outbox:
+            self._reclaim()
+            self._reclaimer.start()
+
+    def submit(self, msg, timeout=MAIL_QUEUE_TIMEOUT):
+        # Blocks while the queue is full; gives up after `timeout` seconds
+        # rather than letting senders pile up without bound.
+        outbox_id = None
+        if self.outbox:
+            outbox_id = self._store(msg)
+        try:
+            self.queue.put((msg, outbox_id), timeout=timeout)
+        except Full:
+            if outbox_id is not None:
+                self._release([outbox_id])
+            self.app.logger.error('mail queue full, %s message to %s',
+                                  'deferring' if outbox_id else 'dropping',
+                                  ', '.join(msg.recipients))
+            return False
+        return True
+
+    def join(self, timeout=None):
+        # Waits until every queued message has been handled, for at most
+        # `timeout` seconds if given; returns whether the queue drained.
+        deadline = None if timeout is None else time.time() + timeout
+        with self.queue.all_tasks_done:
+            while self.queue.unfinished_tasks:
+                remaining = None
+                if deadline is not None:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        return False
+                self.queue.all_tasks_done.wait(remaining)
+        return True
+
+    def _work(self):
+        while True:
+            batch = [self.queue.get()]
+            while len(batch) < self.batch_size:
+                try:
+                    batch.append(self.queue.get_nowait())
+                except Empty:
+                    break
+            try:
+                with self.app.app_context():
+                    self._send(batch)
+            except Exception:
+                self.app.logger.exception('could not send mail')
+            finally:
+                for item in batch:
+                    self.queue.task_done()
+
+    def _send(self, batch):
+        sent = []
+        try:
+            with mail.connect() as connection:
+                for msg, outbox_id in batch:
+                    try:
+                        connection.send(msg)
+                    except smtplib.SMTPRecipientsRefused:
+                        self.app.logger.exception('mail to %s refused',
+                                                  ', '.join(msg.recipients))
+                    if outbox_id is not None:
+                        sent.append(outbox_id)
+        except Exception:
+            unsent = [outbox_id for msg, outbox_id in batch
+                      if outbox_id is not None and outbox_id not in sent]
+            if unsent:
+                self._release(unsent)
+            raise
+        finally:
+            if sent:
+                table = OutboxMessage.__table__
+                with db.engine.begin() as connection:
+                    connection.execute(
+                        table.delete().where(table.c.id.in_(sent)))
+
+    def _store(self, msg):
+        table = OutboxMessage.__table__
+        with db.engine.begin() as connection:
+            result = connection.execute(table.insert().values(
+                payload=message_to_json(msg), claimed_by=self.token,
+                claimed_at=datetime.utcnow()))
+            return result.inserted_primary_key[0]
+
+    def _release(self, ids):
+        table = OutboxMessage.__table__
+        with db.engine.begin() as connection:
+            connection.execute(table.update().where(table.c.id.in_(ids))
+                               .values(claimed_by=None, claimed_at=None))
+
+    def _reclaim(self):
+        # Claim unsent messages that nobody holds, or whose claim is old
+        # enough that the process holding it is presumed gone. The claims on
+        # messages still queued here are renewed first, so neither this nor
+        # another process takes them while they wait.
+        table = OutboxMessage.__table__
+        claim = uuid.uuid4().hex
+        now = datetime.utcnow()
+        with db.engine.begin() as connection:
+            connection.execute(table.update()
+                               .where(table.c.claimed_by == self.token)
+                               .values(claimed_at=now))
+            connection.execute(table.update().where(db.or_(
+                table.c.claimed_by == None,  # noqa: E711
+                table.c.claimed_at < now - MAIL_OUTBOX_CLAIM_TIMEOUT))
+                .values(claimed_by=claim, claimed_at=now))
+            rows = connection.execute(
+                db.select([table.c.id, table.c.payload])
+                .where(table.c.claimed_by == claim)).fetchall()
+            connection.execute(table.update()
+                               .where(table.c.claimed_by == claim)
+                               .values(claimed_by=self.token))
+        for i, (id, payload) in enumerate(rows):
+            try:
+                self.queue.put_nowait((message_from_json(payload), id))
+            except Full:
+                self._release([row[0] for row in rows[i:]])
+                break
+
+
+mail_dispatcher = MailDispatcher(app, MAIL_WORKERS, MAIL_QUEUE_SIZE,
+                                 MAIL_BATCH_SIZE, MAIL_OUTBOX)
+if MAIL_OUTBOX:
+    # recover the outbox as soon as a worker is up, not only once it has
+    # new mail of its own to send
+    app.before_first_request(mail_dispatcher.start)
@@ -0,0 +1,184 @@
+import time
+from bisect import bisect_left
+from threading import Lock
+from flask import g, request, has_request_context, abort, Response, \
+    before_render_template, template_rendered, request_started
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app
+from config import METRICS_ALLOWED_IPS, METRICS_LATENCY_BUCKETS, \
+    METRICS_QUERY_BUCKETS, SERVER_TIMING
+
+# name, help text and buckets of each per endpoint histogram
+HISTOGRAMS = (
+    ('request_seconds', 'Time spent handling the request.',
+     METRICS_LATENCY_BUCKETS),
+    ('sql_seconds', 'Time spent executing SQL statements.',
+     METRICS_LATENCY_BUCKETS),
+    ('render_seconds', 'Time spent rendering templates.',
+     METRICS_LATENCY_BUCKETS),
+    ('python_seconds', 'Time spent outside SQL and templates.',
+     METRICS_LATENCY_BUCKETS),
+    ('sql_queries', 'SQL statements executed.', METRICS_QUERY_BUCKETS),
+)
+
+
+class Histogram(object):
+    # Counts per fixed bucket, so memory doesn't grow with traffic.
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def cumulative(self):
+        total = 0
+        for bound, count in zip(self.buckets + ('+Inf',), self.counts):
+            total += count
+            yield bound, total
+
+
+class Metrics(object):
+
+    def __init__(self, prefix='microblog_'):
+        self.prefix = prefix
+        self.histograms = {}
+        self.lock = Lock()
+
+    def observe(self, endpoint, values):
+        with self.lock:
+            for name, _, buckets in HISTOGRAMS:
+                histogram = self.histograms.get((name, endpoint))
+                if histogram is None:
+                    histogram = self.histograms[(name, endpoint)] = \
+                        Histogram(buckets)
+                histogram.observe(values[name])
+
+    def exposition(self):
+        # the Prometheus text format
+        lines = []
+        with self.lock:
+            for name, description, _ in HISTOGRAMS:
+                metric = self.prefix + name
+                lines.append('# HELP %s %s' % (metric, description))
+                lines.append('# TYPE %s histogram' % metric)
+                for (hname, endpoint), histogram in \
+                        sorted(self.histograms.items()):
+                    if hname != name:
+                        continue
+                    for bound, count in histogram.cumulative():
+                        lines.append('%s_bucket{endpoint="%s",le="%s"} %d' % (
+                            metric, endpoint, bound, count))
+                    lines.append('%s_sum{endpoint="%s"} %r' % (
+                        metric, endpoint, histogram.sum))
+                    lines.append('%s_count{endpoint="%s"} %d' % (
+                        metric, endpoint, sum(histogram.counts)))
+        return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
+
+
+class RequestTimings(object):
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.sql = 0.0
+        self.render = 0.0
+        self.render_sql = 0.0
+        self.rendering = []
+
+    def values(self):
+        total = time.perf_counter() - self.start
+        # SQL run by lazy loads inside templates is counted as SQL only
+        python = total - self.sql - (self.render - self.render_sql)
+        return {
+            'request_seconds': total,
+            'sql_seconds': self.sql,
+            'render_seconds': self.render - self.render_sql,
+            'python_seconds': max(python, 0.0),
+            'sql_queries': self.queries,
+        }
+
+
+def current_timings():
+    if has_request_context():
+        return g.get('timings')
+
+
+@request_started.connect_via(app)
+def start_timings(sender, **extra):
+    g.timings = RequestTimings()
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context,
+                          executemany):
+    if current_timings() is not None:
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context,
+                         executemany):
+    timings = current_timings()
+    if timings is None or not conn.info.get('query_start'):
+        return
+    elapsed = time.perf_counter() - conn.info['query_start'].pop()
+    timings.queries += 1
+    timings.sql += elapsed
+    if timings.rendering:
+        timings.render_sql += elapsed
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    if context.connection is not None and \
+            context.connection.info.get('query_start'):
+        context.connection.info['query_start'].pop()
+
+
+@before_render_template.connect_via(app)
+def before_render(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None:
+        timings.rendering.append(time.perf_counter())
+
+
+@template_rendered.connect_via(app)
+def after_render(sender, template, context, **extra):
+    timings = current_timings()
+    if timings is not None and timings.rendering:
+        elapsed = time.perf_counter() - timings.rendering.pop()
+        # templates rendered from inside another one are already counted
+        if not timings.rendering:
+            timings.render += elapsed
+
+
+@app.after_request
+def record_timings(response):
+    timings = current_timings()
+    if timings is None:
+        return response
+    values = timings.values()
+    metrics.observe(request.endpoint or 'unknown', values)
+    if SERVER_TIMING:
+        response.headers['Server-Timing'] = \
+            'db;dur=%.1f;desc="%d queries", render;dur=%.1f, app;dur=%.1f' % (
+                values['sql_seconds'] * 1000, values['sql_queries'],
+                values['render_seconds'] * 1000,
+                values['python_seconds'] * 1000)
+    return response
+
+
+@app.route('/_metrics')
+def metrics_endpoint():
+    if request.remote_addr not in METRICS_ALLOWED_IPS:
+        abort(404)
+    return Response(metrics.exposition(),
+                    mimetype='text/plain; version=0.0.4')
@@ -1,14 +1,39 @@
 from app import app, db, lm
-from config import SECRET_KEY, REMEMBER_COOKIE_DURATION
+from config import SECRET_KEY, REMEMBER_COOKIE_DURATION, \
+    TIMELINE_FANOUT_LIMIT, POST_AUTHOR_LOADING, SHARED_FOLLOW_SET_CACHE, \
+    SHARED_FOLLOW_SET_CACHE_SIZE, SHARED_FOLLOW_SET_CACHE_TTL, \
+    USER_CACHE_SIZE, USER_CACHE_TTL
+from flask import g, has_app_context
 from flask.ext.login import UserMixin
 from werkzeug import generate_password_hash, check_password_hash
 from itsdangerous import URLSafeTimedSerializer
 from hashlib import md5
+from sqlalchemy.orm import joinedload, subqueryload, \
+    make_transient_to_detached
 import flask.ext.whooshalchemy as whooshalchemy
+from .cache import LRUCache
 
 
 token_serializer = URLSafeTimedSerializer(SECRET_KEY)
 
+AVATAR_URL = 'http://www.gravatar.com/avatar/%s?d=mm&s=%d'
+
+# column values of recently loaded users by id, used by User.load() when
+# USER_CACHE_TTL is set
+user_cache = LRUCache(USER_CACHE_SIZE, USER_CACHE_TTL)
+
+# followed ids by follower id, kept across requests when
+# SHARED_FOLLOW_SET_CACHE is on
+shared_followed_ids = LRUCache(SHARED_FOLLOW_SET_CACHE_SIZE,
+                               SHARED_FOLLOW_SET_CACHE_TTL)
+
+author_loaders = {'joined': joinedload, 'subquery': subqueryload}
+try:
+    from sqlalchemy.orm import selectinload
+    author_loaders['selectin'] = selectinload
+except ImportError:  # SQLAlchemy < 1.2
+    pass
+
 
 @lm.token_loader
 def load_token(token):
@@ -18,7 +43,7 @@ def load_token(token):
     data = token_serializer.loads(token, max_age=max_age)
 
     # Find the User
-    user = User.query.get(data[0])
+    user = User.load(data[0])
 
     # Check pwdhash and return user or None
     if user and data[1] == user.pwdhash:
@@ -27,20 +52,44 @@ def load_token(token):
 
 followers = db.Table('followers',
                      db.Column(
-                         'follower_id', db.Integer, db.ForeignKey('user.id')),
+                         'follower_id', db.Integer, db.ForeignKey('user.id'),
+                         primary_key=True),
                      db.Column(
-                         'followed_id', db.Integer, db.ForeignKey('user.id'))
+                         'followed_id', db.Integer, db.ForeignKey('user.id'),
+                         primary_key=True),
+                     db.Index('ix_followers_followed_id',
+                              'followed_id', 'follower_id')
                      )
 
+# Precomputed home timelines: one row per (reader, post) written when the
+# post is created (fan-out-on-write), so a page of a timeline is a range scan
+# of ix_timeline_owner_timestamp_post instead of a join against followers.
+timeline = db.Table('timeline',
+                    db.Column('owner_id', db.Integer, db.ForeignKey('user.id'),
+                              primary_key=True),
+                    db.Column('post_id', db.Integer, db.ForeignKey('post.id'),
+                              primary_key=True),
+                    db.Column('author_id', db.Integer,
+                              db.ForeignKey('user.id')),
+                    db.Column('timestamp', db.DateTime),
+                    db.Index('ix_timeline_owner_timestamp_post',
+                             'owner_id', 'timestamp', 'post_id')
+                    )
+
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     username = db.Column(db.String(64), index=True, unique=True)
     email = db.Column(db.String(64), index=True, nullable=False, unique=True)
+    email_hash = db.Column(db.String(32))
     pwdhash = db.Column(db.String(64), nullable=True)
     posts = db.relationship('Post', backref='author', lazy='dynamic')
     about_me = db.Column(db.String(140))
     last_seen = db.Column(db.DateTime)
+    followers_count = db.Column(db.Integer, default=0)
+    following_count = db.Column(db.Integer, default=0)
+    # set by edit(); pages showing this user's name or avatar go stale then
+    profile_updated = db.Column(db.DateTime, index=True)
     followed = db.relationship('User',
                                secondary=followers,
                                primaryjoin=(followers.c.follower_id == id),
@@ -51,10 +100,12 @@ class User(UserMixin, db.Model):
     def __init__(self, username, email, password=None, about_me=None):
         self.username = username.title()
         if email is not None:
-            self.email = email.lower()
+            self.set_email(email.lower())
         if password is not None:
             self.set_password(password)
         self.about_me = about_me
+        self.followers_count = 0
+        self.following_count = 0
 
     @property
     def is_authenticated(self):
@@ -84,9 +135,15 @@ class User(UserMixin, db.Model):
         data = [str(self.id), self.pwdhash]
         return token_serializer.dumps(data)
 
+    def set_email(self, email):
+        self.email = email
+        self.email_hash = md5(email.encode('utf-8')).hexdigest()
+
     def avatar(self, size):
-        return 'http://www.gravatar.com/avatar/%s?d=mm&s=%d' % \
-            (md5(self.email.encode('utf-8')).hexdigest(), size)
+        email_hash = self.email_hash
+        if email_hash is None:  # row written before email_hash existed
+            email_hash = md5(self.email.encode('utf-8')).hexdigest()
+        return AVATAR_URL % (email_hash, size)
 
     def has_password(self):
         if self.pwdhash is None:
@@ -97,22 +154,179 @@ class User(UserMixin, db.Model):
     def follow(self, user):
         if not self.is_following(user):
             self.followed.append(user)
+            self._forget_followed_ids()
+            User.forget(self.id)
+            User.forget(user.id)
+            # incremented in SQL, so concurrent follows can't overwrite
+            # each other's counts
+            self.following_count = User.following_count + 1
+            user.followers_count = User.followers_count + 1
+            db.session.flush()
+            if not user.fans_out_on_read():
+                self._backfill_timeline(user)
             return self
 
     def unfollow(self, user):
         if self.is_following(user):
             self.followed.remove(user)
+            self._forget_followed_ids()
+            User.forget(self.id)
+            User.forget(user.id)
+            pulled = user.fans_out_on_read()
+            self.following_count = User.following_count - 1
+            user.followers_count = User.followers_count - 1
+            db.session.flush()
+            db.session.execute(timeline.delete().where(db.and_(
+                timeline.c.owner_id == self.id,
+                timeline.c.author_id == user.id)))
+            if pulled and not user.fans_out_on_read():
+                user._backfill_followers()
             return self
 
     def is_following(self, user):
-        return self.followed.filter(
-                    followers.c.followed_id == user.id).count() > 0
+        return user.id in self.followed_ids()
+
+    def is_following_many(self, users):
+        followed_ids = self.followed_ids()
+        return dict((user.id, user.id in followed_ids) for user in users)
+
+    def followed_ids(self):
+        local = self._local_followed_ids()
+        ids = local.get(self.id)
+        if ids is None and SHARED_FOLLOW_SET_CACHE:
+            ids = shared_followed_ids.get(self.id)
+        if ids is None:
+            ids = frozenset(row[0] for row in
+                            db.session.query(followers.c.followed_id)
+                            .filter(followers.c.follower_id == self.id))
+            if self.id is not None and SHARED_FOLLOW_SET_CACHE:
+                shared_followed_ids.set(self.id, ids)
+        if self.id is not None:
+            local[self.id] = ids
+        return ids
+
+    def _forget_followed_ids(self):
+        self._local_followed_ids().pop(self.id, None)
+        shared_followed_ids.delete(self.id)
+
+    @staticmethod
+    def _local_followed_ids():
+        # followed ids by follower id for the current request (a throwaway
+        # dict outside of one)
+        if not has_app_context():
+            return {}
+        if not hasattr(g, 'followed_ids'):
+            g.followed_ids = {}
+        return g.followed_ids
+
+    def fans_out_on_read(self):
+        # Authors with very large audiences are not copied into every
+        # follower's timeline; their posts are merged in at read time.
+        if TIMELINE_FANOUT_LIMIT is None:
+            return False
+        return (self.followers_count or 0) >= TIMELINE_FANOUT_LIMIT
+
+    def _backfill_timeline(self, user):
+        posts = db.select([db.literal(self.id), Post.id, Post.user_id,
+                           Post.timestamp]).where(Post.user_id == user.id)
+        db.session.execute(timeline.insert().from_select(
+            ['owner_id', 'post_id', 'author_id', 'timestamp'], posts))
+
+    def _backfill_followers(self):
+        # Called when this author drops back under TIMELINE_FANOUT_LIMIT:
+        # the posts written while they fanned out on read were never copied
+        # into their followers' timelines, and are no longer pulled either.
+        missing = ~db.exists().where(db.and_(
+            timeline.c.owner_id == followers.c.follower_id,
+            timeline.c.post_id == Post.id))
+        posts = db.select([followers.c.follower_id, Post.id, Post.user_id,
+                           Post.timestamp]) \
+            .where(db.and_(followers.c.followed_id == self.id,
+                           Post.user_id == self.id, missing))
+        db.session.execute(timeline.insert().from_select(
+            ['owner_id', 'post_id', 'author_id', 'timestamp'], posts))
+
+    def pulled_author_ids(self):
+        # followed authors whose posts are merged in at read time
+        if TIMELINE_FANOUT_LIMIT is None:
+            return []
+        return [row[0] for row in
+                db.session.query(followers.c.followed_id)
+                .join(User, User.id == followers.c.followed_id)
+                .filter(followers.c.follower_id == self.id)
+                .filter(User.followers_count >= TIMELINE_FANOUT_LIMIT)]
 
     def followed_posts(self):
-        return Post.query.join(followers,
-                               (followers.c.followed_id == Post.user_id)) \
-                                .filter(followers.c.follower_id == self.id) \
-                                .order_by(Post.timestamp.desc())
+        return Timeline(self)
+
+    def timeline_version(self):
+        # (newest post id, newest post time) in the timeline, read off the
+        # top of the same indexes a page of it is read from
+        newest = [db.session.query(timeline.c.post_id, timeline.c.timestamp)
+                  .filter(timeline.c.owner_id == self.id)
+                  .order_by(timeline.c.timestamp.desc(),
+                            timeline.c.post_id.desc()).first()]
+        for author_id in self.pulled_author_ids():
+            newest.append(db.session.query(Post.id, Post.timestamp)
+                          .filter(Post.user_id == author_id)
+                          .order_by(Post.timestamp.desc(), Post.id.desc())
+                          .first())
+        newest = [row for row in newest if row is not None]
+        if not newest:
+            return None, None
+        return max(newest, key=lambda row: (row[1], row[0]))
+
+    def followed_profiles_version(self):
+        # newest profile edit among the users whose posts are in the timeline
+        return db.session.query(db.func.max(User.profile_updated)) \
+            .join(followers, followers.c.followed_id == User.id) \
+            .filter(followers.c.follower_id == self.id).scalar()
+
+    @staticmethod
+    def profiles_version():
+        # newest profile edit of anyone, read off ix_user_profile_updated
+        return db.session.query(db.func.max(User.profile_updated)).scalar()
+
+    @staticmethod
+    def recount_follows():
+        table = User.__table__
+        count = db.select([db.func.count()]).select_from(followers)
+        db.session.execute(table.update().values(
+            followers_count=count.where(
+                followers.c.followed_id == table.c.id).as_scalar(),
+            following_count=count.where(
+                followers.c.follower_id == table.c.id).as_scalar()))
+
+    @staticmethod
+    def rebuild_timelines():
+        db.session.execute(timeline.delete())
+        posts = db.select([followers.c.follower_id, Post.id, Post.user_id,
+                           Post.timestamp]) \
+            .where(followers.c.followed_id == Post.user_id)
+        db.session.execute(timeline.insert().from_select(
+            ['owner_id', 'post_id', 'author_id', 'timestamp'], posts))
+
+    @staticmethod
+    def load(id):
+        # One primary key lookup at most; with USER_CACHE_TTL set, a recently
+        # loaded user is attached to the session without a query at all.
+        id = int(id)
+        values = user_cache.get(id) if USER_CACHE_TTL else None
+        if values is not None:
+            user = User.__mapper__.class_manager.new_instance()
+            for key, value in values.items():
+                setattr(user, key, value)
+            make_transient_to_detached(user)
+            return db.session.merge(user, load=False)
+        user = User.query.get(id)
+        if user is not None and USER_CACHE_TTL:
+            user_cache.set(id, dict((attr.key, getattr(user, attr.key))
+                                    for attr in User.__mapper__.column_attrs))
+        return user
+
+    @staticmethod
+    def forget(id):
+        user_cache.delete(id)
 
     @staticmethod
     def create_unique_username(username):
@@ -139,8 +353,82 @@ class Post(db.Model):
     timestamp = db.Column(db.DateTime)
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'))
 
+    @staticmethod
+    def load_authors():
+        # Loader option that fetches post authors along with the posts, so
+        # rendering a page of posts doesn't lazy-load each author.
+        return author_loaders[POST_AUTHOR_LOADING](Post.author)
+
+    def fan_out(self):
+        if self.author.fans_out_on_read():
+            return
+        readers = db.select([followers.c.follower_id, db.literal(self.id),
+                             db.literal(self.user_id),
+                             db.literal(self.timestamp)]) \
+            .where(followers.c.followed_id == self.user_id)
+        db.session.execute(timeline.insert().from_select(
+            ['owner_id', 'post_id', 'author_id', 'timestamp'], readers))
+
     def __repr__(self):
         return '<Post %r>' % (self.body)
 
 
+# a user's posts newest first, for profile pages and timeline pulls
+db.Index('ix_post_user_timestamp',
+         Post.user_id, Post.timestamp.desc(), Post.id)
+
+
+class Timeline(object):
+    # A reader's home timeline, newest first. It is made of parts, each a
+    # query of posts together with the (timestamp, id) columns its index is
+    # ordered on: the rows fanned out to the reader, plus one part per
+    # followed author who fans out on read. app.pagination reads a page as
+    # a range of every part and merges them.
+
+    def __init__(self, user):
+        self.user = user
+
+    def parts(self):
+        parts = [(Post.query.options(Post.load_authors())
+                  .join(timeline, timeline.c.post_id == Post.id)
+                  .filter(timeline.c.owner_id == self.user.id),
+                  timeline.c.timestamp, timeline.c.post_id)]
+        for author_id in self.user.pulled_author_ids():
+            parts.append((Post.query.options(Post.load_authors())
+                          .filter(Post.user_id == author_id),
+                          Post.timestamp, Post.id))
+        return parts
+
+    def all(self):
+        posts = {}
+        for query, timestamp, id in self.parts():
+            for post in query:
+                posts[post.id] = post
+        return sorted(posts.values(), key=lambda post: (post.timestamp,
+                                                        post.id),
+                      reverse=True)
+
+    def count(self):
+        # an author who went over TIMELINE_FANOUT_LIMIT can have posts in
+        # both parts, so ids are counted once
+        ids = db.select([timeline.c.post_id]) \
+            .where(timeline.c.owner_id == self.user.id)
+        pulled = self.user.pulled_author_ids()
+        if pulled:
+            ids = db.union(ids, db.select([Post.id])
+                           .where(Post.user_id.in_(pulled)))
+        return db.session.execute(db.select([db.func.count()])
+                                  .select_from(ids.alias())).scalar()
+
+
+class OutboxMessage(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    payload = db.Column(db.Text)
+    claimed_by = db.Column(db.String(32), index=True)
+    claimed_at = db.Column(db.DateTime)
+
+    def __repr__(self):
+        return '<OutboxMessage %r>' % (self.id)
+
+
 whooshalchemy.whoosh_index(app, Post)
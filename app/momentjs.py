@@ -1,21 +1,155 @@
-from jinja2 import Markup
+import re
+from datetime import datetime, timedelta
+from jinja2 import Markup, escape
+from .cache import LRUCache
+
+# relative times are worked out against the current time rounded down to
+# NOW_BUCKET seconds, so each (timestamp, bucket) is formatted only once
+NOW_BUCKET = 60
+formatted = LRUCache(4096)
+
+FORMAT_TOKENS = re.compile(r'\[[^\]]*\]|YYYY|YY|MMMM|MMM|MM|M|Do|DD|D|dddd|'
+                           r'ddd|HH|H|hh|h|mm|m|ss|s|A|a')
+
+
+def ordinal(n):
+    if 10 <= n % 100 <= 20:
+        return '%dth' % n
+    return '%d%s' % (n, {1: 'st', 2: 'nd', 3: 'rd'}.get(n % 10, 'th'))
+
+
+def format_token(timestamp, token):
+    if token.startswith('['):
+        return token[1:-1]
+    hour12 = timestamp.hour % 12 or 12
+    return {
+        'YYYY': '%04d' % timestamp.year,
+        'YY': '%02d' % (timestamp.year % 100),
+        'MMMM': timestamp.strftime('%B'),
+        'MMM': timestamp.strftime('%b'),
+        'MM': '%02d' % timestamp.month,
+        'M': '%d' % timestamp.month,
+        'Do': ordinal(timestamp.day),
+        'DD': '%02d' % timestamp.day,
+        'D': '%d' % timestamp.day,
+        'dddd': timestamp.strftime('%A'),
+        'ddd': timestamp.strftime('%a'),
+        'HH': '%02d' % timestamp.hour,
+        'H': '%d' % timestamp.hour,
+        'hh': '%02d' % hour12,
+        'h': '%d' % hour12,
+        'mm': '%02d' % timestamp.minute,
+        'm': '%d' % timestamp.minute,
+        'ss': '%02d' % timestamp.second,
+        's': '%d' % timestamp.second,
+        'A': 'PM' if timestamp.hour >= 12 else 'AM',
+        'a': 'pm' if timestamp.hour >= 12 else 'am',
+    }[token]
+
+
+def format_moment(timestamp, fmt):
+    # a server side subset of moment.js' format() tokens
+    return FORMAT_TOKENS.sub(lambda match: format_token(timestamp,
+                                                        match.group(0)), fmt)
+
+
+def from_now(timestamp, now):
+    # the same thresholds moment.js uses for fromNow()
+    seconds = (now - timestamp).total_seconds()
+    future = seconds < 0
+    seconds = abs(seconds)
+    minutes = seconds / 60
+    hours = minutes / 60
+    days = hours / 24
+    if seconds < 45:
+        text = 'a few seconds'
+    elif seconds < 90:
+        text = 'a minute'
+    elif minutes < 45:
+        text = '%d minutes' % round(minutes)
+    elif minutes < 90:
+        text = 'an hour'
+    elif hours < 22:
+        text = '%d hours' % round(hours)
+    elif hours < 36:
+        text = 'a day'
+    elif days < 26:
+        text = '%d days' % round(days)
+    elif days < 45:
+        text = 'a month'
+    elif days < 320:
+        text = '%d months' % round(days / 30.4)
+    elif days < 548:
+        text = 'a year'
+    else:
+        text = '%d years' % round(days / 365.25)
+    if future:
+        return 'in ' + text
+    return text + ' ago'
+
+
+def calendar(timestamp, now):
+    at = format_moment(timestamp, 'h:mm A')
+    days = (timestamp.date() - now.date()).days
+    if days < -6 or days >= 7:
+        return format_moment(timestamp, 'MM/DD/YYYY')
+    if days < -1:
+        return format_moment(timestamp, '[Last] dddd [at] ') + at
+    if days == -1:
+        return 'Yesterday at ' + at
+    if days == 0:
+        return 'Today at ' + at
+    if days == 1:
+        return 'Tomorrow at ' + at
+    return format_moment(timestamp, 'dddd [at] ') + at
+
+
+def now_bucket(now=None):
+    # `now` (the current UTC time by default) rounded down to NOW_BUCKET
+    if now is None:
+        now = datetime.utcnow()
+    return datetime.utcfromtimestamp(
+        int((now - datetime(1970, 1, 1)).total_seconds()) //
+        NOW_BUCKET * NOW_BUCKET)
 
 
 class momentjs(object):
+    # Renders times on the server as <time> elements. static/js/moment-time.js
+    # then rewrites them all in the reader's local time in a single pass.
 
-    def __init__(self, timestamp):
+    def __init__(self, timestamp, now=None):
         self.timestamp = timestamp
+        self.now = now_bucket(now)
+
+    def render(self, kind, text, pattern=None):
+        pattern_attribute = ''
+        if pattern is not None:
+            pattern_attribute = ' data-pattern="%s"' % escape(pattern)
+        return Markup('<time datetime="%s" data-moment="%s"%s>%s</time>'
+                      % (self.timestamp.strftime("%Y-%m-%dT%H:%M:%SZ"),
+                         kind, pattern_attribute, escape(text)))
 
-    def render(self, format):
-        return Markup("<script>\ndocument.write(moment(\"%s\").%s);\n</script>"
-                      % (self.timestamp.strftime("%Y-%m-%dT%H:%M:%S Z"),
-                         format))
+    def cached(self, key, func):
+        text = formatted.get(key)
+        if text is None:
+            text = func()
+            formatted.set(key, text)
+        return text
 
     def format(self, fmt):
-        return self.render("format(\"%s\")" % fmt)
+        return self.render('format', self.cached(
+            ('format', fmt, self.timestamp),
+            lambda: format_moment(self.timestamp, fmt)), fmt)
 
     def calendar(self):
-        return self.render("calendar()")
+        return self.render('calendar', self.cached(
+            ('calendar', self.timestamp, self.now),
+            lambda: calendar(self.timestamp, self.now)))
 
     def fromNow(self):
-        return self.render("fromNow()")
+        now = self.now
+        if timedelta(0) < self.timestamp - now < timedelta(seconds=NOW_BUCKET):
+            now = self.timestamp  # newer than the start of the bucket
+        return self.render('fromNow', self.cached(
+            ('fromNow', self.timestamp, now),
+            lambda: from_now(self.timestamp, now)))
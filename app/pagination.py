@@ -0,0 +1,116 @@
+import base64
+from datetime import datetime
+from app import db
+from .models import Post
+
+CURSOR_FORMAT = '%Y-%m-%dT%H:%M:%S.%f'
+
+
+def encode_cursor(post):
+    raw = '%s|%d' % (post.timestamp.strftime(CURSOR_FORMAT), post.id)
+    token = base64.urlsafe_b64encode(raw.encode('utf-8'))
+    return token.decode('ascii').rstrip('=')
+
+
+def decode_cursor(token):
+    if not token:
+        return None
+    try:
+        padded = (token + '=' * (-len(token) % 4)).encode('ascii')
+        raw = base64.urlsafe_b64decode(padded).decode('utf-8')
+        timestamp, id = raw.split('|')
+        return datetime.strptime(timestamp, CURSOR_FORMAT), int(id)
+    except (ValueError, TypeError, UnicodeError):
+        return None
+
+
+class KeysetPage(object):
+
+    def __init__(self, items, has_prev, has_next, total=None):
+        self.items = items
+        self.has_prev = has_prev
+        self.has_next = has_next
+        self.total = total
+
+    @property
+    def prev_cursor(self):
+        if not self.items:
+            return None
+        return encode_cursor(self.items[0])
+
+    @property
+    def next_cursor(self):
+        if not self.items:
+            return None
+        return encode_cursor(self.items[-1])
+
+
+def keyset_parts(query):
+    # (query, timestamp column, id column) for each part of `query`, which
+    # is either a query of posts or a models.Timeline
+    if hasattr(query, 'parts'):
+        return query.parts()
+    return [(query, Post.timestamp, Post.id)]
+
+
+def keyset_range(query, timestamp_column, id_column, cursor=None,
+                 older=True):
+    # `query` ordered on its index, newest first below `cursor` or oldest
+    # first above it. The cursor is spelled as a range on the timestamp
+    # plus a tie-break, which SQLite can still read off the index.
+    query = query.order_by(None)
+    if cursor is not None:
+        timestamp, id = cursor
+        if older:
+            query = query.filter(timestamp_column <= timestamp,
+                                 db.or_(timestamp_column < timestamp,
+                                        id_column < id))
+        else:
+            query = query.filter(timestamp_column >= timestamp,
+                                 db.or_(timestamp_column > timestamp,
+                                        id_column > id))
+    if older:
+        return query.order_by(timestamp_column.desc(), id_column.desc())
+    return query.order_by(timestamp_column.asc(), id_column.asc())
+
+
+def newest_first(query, before=None):
+    # a query of posts ordered newest first, starting below `before`
+    return keyset_range(query, Post.timestamp, Post.id,
+                        decode_cursor(before))
+
+
+def fetch(query, limit, cursor=None, older=True):
+    # the first `limit` posts of every part, merged and cut to `limit`
+    posts = {}
+    for part, timestamp_column, id_column in keyset_parts(query):
+        for post in keyset_range(part, timestamp_column, id_column, cursor,
+                                 older).limit(limit):
+            posts[post.id] = post
+    return sorted(posts.values(), key=lambda post: (post.timestamp, post.id),
+                  reverse=older)[:limit]
+
+
+def count(query):
+    if hasattr(query, 'parts'):
+        return query.count()
+    return query.order_by(None).count()
+
+
+def paginate(query, per_page, before=None, after=None, with_total=False):
+    # Pages are keyed on (timestamp, id) rather than an OFFSET, so deep
+    # pages cost the same as the first one. The total is only counted on
+    # request since it scans the whole result set.
+    total = None
+    if with_total:
+        total = count(query)
+    newer = decode_cursor(after)
+    if newer is not None:
+        rows = fetch(query, per_page + 1, newer, older=False)
+        items = rows[:per_page]
+        items.reverse()
+        return KeysetPage(items, len(rows) > per_page, True, total)
+    older = decode_cursor(before)
+    rows = fetch(query, per_page + 1, older)
+    return KeysetPage(rows[:per_page], older is not None,
+                      len(rows) > per_page, total)
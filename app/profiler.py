@@ -0,0 +1,166 @@
+import os
+import sys
+import time
+import random
+import threading
+from collections import Counter
+from datetime import datetime
+from flask import g, request, request_started
+from app import app
+from config import PROFILE_ENABLED, PROFILE_THRESHOLD, PROFILE_SAMPLE_RATE, \
+    PROFILE_INTERVAL, PROFILE_DIR
+
+
+def frame_name(frame):
+    code = frame.f_code
+    return '%s (%s:%d)' % (code.co_name, os.path.relpath(code.co_filename),
+                           code.co_firstlineno)
+
+
+def collapse(frame):
+    names = []
+    while frame is not None:
+        names.append(frame_name(frame))
+        frame = frame.f_back
+    return ';'.join(reversed(names))
+
+
+class RequestProfile(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.start = time.time()
+        self.samples = Counter()
+
+
+class SamplingProfiler(object):
+    # Samples the stacks of threads that are inside begin() / end() from a
+    # daemon thread, which only wakes up while there is something to sample.
+    # sys._current_frames() only sees OS threads, keyed by ids that gevent's
+    # patched get_ident() doesn't return, so profiling is switched off when
+    # threading is monkey-patched (see gevent_patched()).
+
+    def __init__(self, interval, directory):
+        self.interval = interval
+        self.directory = directory
+        self.active = {}
+        self._busy = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+
+    def start(self):
+        if self._thread is not None:
+            return
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._thread = threading.Thread(target=self._run)
+            self._thread.daemon = True
+            self._thread.start()
+
+    def begin(self, name):
+        self.start()
+        profile = RequestProfile(name)
+        self.active[threading.get_ident()] = profile
+        self._busy.set()
+        return profile
+
+    def end(self, profile, keep):
+        self.active.pop(threading.get_ident(), None)
+        if not self.active:
+            self._busy.clear()
+        if keep and profile.samples:
+            return self.write(profile)
+
+    def write(self, profile):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = os.path.join(self.directory, '%s-%s-%dms.folded' % (
+            datetime.utcnow().strftime('%Y%m%d%H%M%S%f'), profile.name,
+            (time.time() - profile.start) * 1000))
+        with open(path, 'w') as f:
+            for stack, count in profile.samples.most_common():
+                f.write('%s %d\n' % (stack, count))
+        return path
+
+    def sample(self):
+        frames = sys._current_frames()
+        for ident, profile in list(self.active.items()):
+            frame = frames.get(ident)
+            if frame is not None:
+                profile.samples[collapse(frame)] += 1
+
+    def _run(self):
+        while True:
+            self._busy.wait()
+            time.sleep(self.interval)
+            self.sample()
+
+
+def load_profiles(directory, endpoint=None):
+    # (file count, merged samples) of the .folded files in `directory`,
+    # optionally only those recorded for `endpoint`
+    files = 0
+    samples = Counter()
+    if not os.path.isdir(directory):
+        return files, samples
+    for filename in sorted(os.listdir(directory)):
+        if not filename.endswith('.folded') or filename == 'merged.folded':
+            continue
+        if endpoint is not None and \
+                filename.split('-')[1] != endpoint:
+            continue
+        files += 1
+        with open(os.path.join(directory, filename)) as f:
+            for line in f:
+                stack, _, count = line.rstrip('\n').rpartition(' ')
+                samples[stack] += int(count)
+    return files, samples
+
+
+def hot_frames(samples, top=20):
+    # (self, total) sample counts of the busiest frames; "self" counts the
+    # samples where the frame was running, "total" also those where it was
+    # waiting on a callee
+    own = Counter()
+    total = Counter()
+    for stack, count in samples.items():
+        names = stack.split(';')
+        own[names[-1]] += count
+        for name in set(names):
+            total[name] += count
+    return [(name, count, total[name])
+            for name, count in own.most_common(top)]
+
+
+def gevent_patched():
+    try:
+        from gevent import monkey
+    except ImportError:
+        return False
+    return monkey.is_module_patched('threading')
+
+
+profiler = SamplingProfiler(PROFILE_INTERVAL, PROFILE_DIR)
+profiling = PROFILE_ENABLED
+if profiling and gevent_patched():
+    app.logger.warning('PROFILE_ENABLED is ignored: threading is patched by '
+                       'gevent, run the profiled server threaded instead')
+    profiling = False
+
+
+@request_started.connect_via(app)
+def start_profile(sender, **extra):
+    if profiling:
+        g.profile = profiler.begin(request.endpoint or 'unknown')
+        g.profile_sampled = random.random() < PROFILE_SAMPLE_RATE
+
+
+@app.teardown_request
+def finish_profile(exc):
+    profile = g.pop('profile', None)
+    if profile is None:
+        return
+    slow = PROFILE_THRESHOLD is not None and \
+        time.time() - profile.start >= PROFILE_THRESHOLD
+    profiler.end(profile, slow or g.profile_sampled)
@@ -0,0 +1,272 @@
+import json
+import os
+import glob
+import fcntl
+import threading
+from collections import OrderedDict
+from flask.ext.sqlalchemy import models_committed
+from whoosh.index import LockError
+from whoosh.writing import CLEAR
+import flask.ext.whooshalchemy as whooshalchemy
+from app import app, db
+from config import SEARCH_INDEX_BATCH, SEARCH_INDEX_INTERVAL, \
+    SEARCH_INDEX_SPILL, SEARCH_INDEX_LOCK_TIMEOUT, MAX_SEARCH_RESULTS, \
+    SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL
+from .background import Flusher
+from .cache import LRUCache
+from .models import Post
+
+# whooshalchemy indexes synchronously inside every commit; changes go
+# through index_queue instead
+models_committed.disconnect(whooshalchemy._after_flush)
+
+
+def post_index():
+    # whooshalchemy.whoosh_index() reopens the index on every call; the one
+    # it opened when models.py was imported is kept here
+    return app.whoosh_indexes[Post.__name__]
+
+
+def search_document(post):
+    fields = dict((key, str(getattr(post, key)))
+                  for key in Post.__searchable__)
+    fields['id'] = str(post.id)
+    return fields
+
+
+def read_spill(path):
+    changes = []
+    if not os.path.exists(path):
+        return changes
+    with open(path) as spill:
+        for line in spill:
+            try:
+                id, update = json.loads(line)
+            except ValueError:  # torn write at crash time
+                continue
+            changes.append((id, update))
+    return changes
+
+
+class IndexQueue(object):
+    # Post ids waiting to be (re)indexed or removed from the Whoosh index.
+    # A single background writer applies them in one Whoosh commit per
+    # `batch_size` posts or `interval` seconds. Every change is appended to
+    # a spill file first, so a crash loses nothing. Each process spills to
+    # its own file, next to `path` and named after its pid, and holds a
+    # lock on it while it runs; recover() replays the files of processes
+    # that are gone.
+
+    def __init__(self, path, batch_size, interval):
+        self.path = path
+        self.batch_size = batch_size
+        # post id -> True to index, False to drop
+        self._pending = OrderedDict()
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._flusher = Flusher(self.flush, interval)
+        self._owner = None  # (pid, lock file) of the current spill file
+
+    def spill_path(self, pid, suffix=''):
+        root, ext = os.path.splitext(self.path)
+        return '%s.%s%s%s' % (root, pid, ext, suffix)
+
+    def _spill_path(self):
+        # this process' spill file; called with self._lock held
+        pid = os.getpid()
+        if self._owner is None or self._owner[0] != pid:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            lock = open(self.spill_path(pid, '.lock'), 'w')
+            fcntl.lockf(lock, fcntl.LOCK_EX)
+            self._owner = (pid, lock)
+            # left behind by a dead process that had the same pid
+            for id, update in read_spill(self.spill_path(pid)):
+                self._pending.pop(id, None)
+                self._pending[id] = update
+        return self.spill_path(pid)
+
+    def _append(self, changes):
+        with open(self._spill_path(), 'a') as spill:
+            for id, update in changes:
+                spill.write(json.dumps([id, update]) + '\n')
+                self._pending.pop(id, None)
+                self._pending[id] = update
+
+    def enqueue(self, changes):
+        with self._lock:
+            self._append(changes)
+            full = len(self._pending) >= self.batch_size
+        self._flusher.start()
+        if full:
+            self._flusher.wake()
+
+    def recover(self):
+        # Takes over the spill files whose lock nobody holds; a file is
+        # removed once its changes are in this process' own spill file.
+        own_path = self.spill_path(os.getpid())
+        for path in glob.glob(self.spill_path('*')):
+            # locking our own file again and closing it would release the
+            # lock this process holds on it
+            if path == own_path:
+                continue
+            lock_path = path + '.lock'
+            try:
+                lock = open(lock_path, 'a')
+            except OSError:
+                continue
+            try:
+                fcntl.lockf(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:  # its process is still running
+                lock.close()
+                continue
+            try:
+                changes = read_spill(path)
+                with self._lock:
+                    self._append(changes)
+                os.remove(path)
+                os.remove(lock_path)
+            except OSError:  # taken over by another process meanwhile
+                pass
+            finally:
+                lock.close()
+        with self._lock:
+            pending = len(self._pending)
+        if pending:
+            self._flusher.start()
+            self._flusher.wake()
+
+    def flush(self):
+        with self._flush_lock:
+            with self._lock:
+                batch, self._pending = self._pending, OrderedDict()
+            if not batch:
+                return
+            try:
+                self._write(batch)
+            except LockError:
+                # another process (or a reindex) is writing the index; the
+                # changes are still spilled, try again on the next flush
+                self._requeue(batch)
+                return
+            except Exception:
+                self._requeue(batch)
+                raise
+            with self._lock:
+                self._rewrite_spill()
+
+    def _requeue(self, batch):
+        with self._lock:
+            for id, update in batch.items():
+                self._pending.setdefault(id, update)
+
+    def _write(self, batch):
+        with app.app_context():
+            index = post_index()
+            ids = [id for id, update in batch.items() if update]
+            posts = {}
+            for start in range(0, len(ids), 500):
+                for post in Post.query.filter(
+                        Post.id.in_(ids[start:start + 500])):
+                    posts[post.id] = post
+            with index.writer(timeout=SEARCH_INDEX_LOCK_TIMEOUT) as writer:
+                for id, update in batch.items():
+                    if update and id in posts:
+                        writer.update_document(**search_document(posts[id]))
+                    else:
+                        writer.delete_by_term('id', str(id))
+
+    def _rewrite_spill(self):
+        spill_path = self._spill_path()
+        with open(spill_path + '.new', 'w') as spill:
+            for id, update in self._pending.items():
+                spill.write(json.dumps([id, update]) + '\n')
+        os.rename(spill_path + '.new', spill_path)
+
+
+index_queue = IndexQueue(SEARCH_INDEX_SPILL, SEARCH_INDEX_BATCH,
+                         SEARCH_INDEX_INTERVAL)
+
+
+def queue_search_changes(sender, changes):
+    posts = [(model.id, operation != 'delete')
+             for model, operation in changes if isinstance(model, Post)]
+    if posts:
+        index_queue.enqueue(posts)
+
+models_committed.connect(queue_search_changes, sender=app)
+# not at import: a server that imports the app before forking its workers
+# would otherwise start the writer thread in the parent, where no worker
+# has it
+app.before_first_request(index_queue.recover)
+
+
+def reindex(procs=4, chunk_size=1000):
+    # Rebuilds the whole index from the post table. Posts are read in id
+    # ranges of chunk_size and indexed by `procs` Whoosh worker processes;
+    # the old segments are dropped when the new ones are committed.
+    writer = post_index().writer(procs=procs, multisegment=True)
+    indexed = 0
+    last_id = 0
+    try:
+        while True:
+            posts = Post.query.filter(Post.id > last_id) \
+                .order_by(Post.id).limit(chunk_size).all()
+            if not posts:
+                break
+            for post in posts:
+                writer.add_document(**search_document(post))
+            indexed += len(posts)
+            last_id = posts[-1].id
+            db.session.expunge_all()
+    except Exception:
+        writer.cancel()
+        raise
+    writer.commit(mergetype=CLEAR)
+    return indexed
+
+
+# ordered post ids by (query, index generation); a commit to the index
+# starts a new generation, so stale entries are simply never hit again
+search_cache = LRUCache(SEARCH_CACHE_SIZE, SEARCH_CACHE_TTL)
+
+
+class SearchPage(object):
+
+    def __init__(self, items, page, has_next, total):
+        self.items = items
+        self.page = page
+        self.has_prev = page > 1
+        self.has_next = has_next
+        self.total = total
+
+
+def search_generation():
+    return post_index().latest_generation()
+
+
+def search_post_ids(query):
+    index = post_index()
+    key = (query, index.latest_generation())
+    ids = search_cache.get(key)
+    if ids is None:
+        with index.searcher() as searcher:
+            results = searcher.search(Post.pure_whoosh.parser.parse(query),
+                                      limit=MAX_SEARCH_RESULTS)
+            ids = [int(hit['id']) for hit in results]
+        search_cache.set(key, ids)
+    return ids
+
+
+def search_posts(query, page, per_page):
+    # Whoosh only runs on a cache miss; each page is then hydrated with a
+    # single IN query and put back into score order.
+    ids = search_post_ids(query)
+    start = (page - 1) * per_page
+    page_ids = ids[start:start + per_page]
+    posts = {}
+    if page_ids:
+        for post in Post.query.options(Post.load_authors()) \
+                .filter(Post.id.in_(page_ids)):
+            posts[post.id] = post
+    return SearchPage([posts[id] for id in page_ids if id in posts], page,
+                      len(ids) > start + per_page, len(ids))
@@ -0,0 +1,135 @@
+import os
+import re
+import time
+import logging
+import threading
+import traceback
+from logging.handlers import RotatingFileHandler
+from flask import request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from config import basedir, SLOW_QUERY_THRESHOLD, SLOW_QUERY_LOG, \
+    SLOW_QUERY_SHAPES
+from .cache import LRUCache
+
+LITERALS = re.compile(r"'(?:[^']|'')*'|\b\d+(?:\.\d+)?\b")
+IN_LISTS = re.compile(r'IN \((?:\?, )*\?\)')
+WHITESPACE = re.compile(r'\s+')
+EXPLAINABLE = ('SELECT', 'INSERT', 'UPDATE', 'DELETE', 'WITH')
+
+
+def statement_shape(statement):
+    # the statement with literals and the length of IN lists taken out, so
+    # the same query with other values has the same shape
+    shape = LITERALS.sub('?', statement)
+    shape = WHITESPACE.sub(' ', shape).strip()
+    return IN_LISTS.sub('IN (...)', shape)
+
+
+def call_site():
+    # the innermost frame in this project's own code
+    for filename, lineno, function, _ in reversed(traceback.extract_stack()):
+        if filename.startswith(basedir) and filename != __file__ and \
+                'site-packages' not in filename:
+            return '%s:%d (%s)' % (os.path.relpath(filename, basedir), lineno,
+                                   function)
+    return 'unknown'
+
+
+def explain(cursor, statement, parameters):
+    plan = cursor.connection.cursor()
+    try:
+        plan.execute('EXPLAIN QUERY PLAN ' + statement, parameters)
+        return [row[-1] for row in plan.fetchall()]
+    except Exception as e:
+        return ['(no plan: %s)' % e]
+    finally:
+        plan.close()
+
+
+class SlowQueryLog(object):
+    # The first slow statement of each shape is logged in full, with the
+    # query plan; after that the shape's count, mean and max are logged
+    # again only when the count reaches a power of two.
+
+    def __init__(self, threshold, path, shapes):
+        self.threshold = threshold
+        self.path = path
+        self.shapes = LRUCache(shapes)
+        self._lock = threading.Lock()
+        self._logger = None
+
+    @property
+    def logger(self):
+        if self._logger is None:
+            directory = os.path.dirname(self.path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            handler = RotatingFileHandler(self.path, 'a', 1 * 1024 * 1024, 10)
+            handler.setFormatter(logging.Formatter('%(asctime)s %(message)s'))
+            logger = logging.Logger('microblog.slowquery')
+            logger.addHandler(handler)
+            self._logger = logger
+        return self._logger
+
+    def record(self, conn, cursor, statement, parameters, executemany,
+               elapsed):
+        shape = statement_shape(statement)
+        with self._lock:
+            stats = self.shapes.get(shape)
+            if stats is None:
+                stats = {'count': 0, 'total': 0.0, 'max': 0.0}
+                self.shapes.set(shape, stats)
+            stats['count'] += 1
+            stats['total'] += elapsed
+            stats['max'] = max(stats['max'], elapsed)
+            count = stats['count']
+        endpoint = request.endpoint if has_request_context() \
+            else threading.current_thread().name
+        if count > 1:
+            if count & (count - 1) == 0:
+                self.logger.warning(
+                    'slow query seen %d times, mean %.1fms, max %.1fms, '
+                    'last in %s at %s\n    %s', count,
+                    stats['total'] / count * 1000, stats['max'] * 1000,
+                    endpoint, call_site(), shape)
+            return
+        if executemany:
+            parameters = parameters[0] if parameters else ()
+        lines = ['slow query %.1fms in %s at %s' % (
+            elapsed * 1000, endpoint, call_site()),
+            '    %s' % WHITESPACE.sub(' ', statement).strip(),
+            '    parameters: %r' % (parameters,)]
+        if conn.dialect.name == 'sqlite' and \
+                shape.split(' ', 1)[0].upper() in EXPLAINABLE:
+            for step in explain(cursor, statement, parameters):
+                lines.append('    plan: %s' % step)
+        self.logger.warning('\n'.join(lines))
+
+
+slow_query_log = SlowQueryLog(SLOW_QUERY_THRESHOLD, SLOW_QUERY_LOG,
+                              SLOW_QUERY_SHAPES)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def start_query(conn, cursor, statement, parameters, context, executemany):
+    if slow_query_log.threshold is not None:
+        conn.info.setdefault('slow_query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def end_query(conn, cursor, statement, parameters, context, executemany):
+    if not conn.info.get('slow_query_start'):
+        return
+    elapsed = time.time() - conn.info['slow_query_start'].pop()
+    if slow_query_log.threshold is not None and \
+            elapsed >= slow_query_log.threshold:
+        slow_query_log.record(conn, cursor, statement, parameters,
+                              executemany, elapsed)
+
+
+@event.listens_for(Engine, 'handle_error')
+def query_failed(context):
+    if context.connection is not None and \
+            context.connection.info.get('slow_query_start'):
+        context.connection.info['slow_query_start'].pop()
@@ -0,0 +1,16 @@
+// Listens for new posts from followed users and offers to reload the
+// timeline, instead of the reader refreshing the page to check.
+(function () {
+  var banner = document.getElementById('live-posts');
+  if (!banner || !window.EventSource) {
+    return;
+  }
+  var count = 0;
+  var source = new EventSource(banner.getAttribute('data-url'));
+  source.addEventListener('post', function () {
+    count += 1;
+    banner.querySelector('a').textContent =
+      count + (count === 1 ? ' new post' : ' new posts') + ', click to show';
+    banner.style.display = '';
+  });
+})();
@@ -0,0 +1,24 @@
+// Rewrites every <time data-moment> element rendered by app/momentjs.py in
+// the reader's local time, in one pass once the page has been parsed, and
+// again every minute so relative times stay current.
+(function () {
+  function refresh() {
+    var nodes = document.querySelectorAll('time[data-moment]');
+    for (var i = 0; i < nodes.length; i++) {
+      var node = nodes[i];
+      var time = moment.utc(node.getAttribute('datetime')).local();
+      var kind = node.getAttribute('data-moment');
+      if (kind === 'format') {
+        node.textContent = time.format(node.getAttribute('data-pattern'));
+      } else {
+        node.textContent = time[kind]();
+      }
+    }
+  }
+  if (document.readyState === 'loading') {
+    document.addEventListener('DOMContentLoaded', refresh);
+  } else {
+    refresh();
+  }
+  setInterval(refresh, 60 * 1000);
+})();
@@ -1,49 +1,97 @@
-from flask import render_template, flash, redirect, url_for, request, g
+import json
+from flask import render_template, flash, redirect, url_for, request, g, \
+    Response
 from app import app, db, lm
 from .forms import LoginForm, SignupForm, EditForm, PostForm, SearchForm
 from .models import User, Post
 from flask.ext.login import login_user, logout_user,\
     current_user, login_required
 from oauth import OAuthSignIn
+import time
 from datetime import datetime
+from zlib import crc32
 from config import POSTS_PER_PAGE_PROFILE, POSTS_PER_PAGE_INDEX,\
-    MAX_SEARCH_RESULTS
+    SEARCH_RESULTS_PER_PAGE, ETAG_CSRF_WINDOW, LIVE_HEARTBEAT, \
+    LIVE_MAX_DURATION, LIVE_RETRY
 from .emails import follower_notification
+from .pagination import paginate
+from .lastseen import last_seen_buffer
+from .search import search_posts, search_generation
+from .decorators import conditional, page_etag, read_only
+from .live import live_posts
 
 
 @lm.user_loader
 def load_user(id):
-    if User.query.get(id) is not None:
-        return User.query.get(id)
-    else:
-        return None
+    return User.load(id)
 
 
 @app.before_request
 def before_request():
     g.user = current_user
     if g.user.is_authenticated:
-        g.user.last_seen = datetime.utcnow()
-        db.session.add(g.user)
-        db.session.commit()
+        last_seen_buffer.touch(g.user)
         g.search_form = SearchForm()
 
 
+def viewer_version():
+    # Everything about the viewer that shows up on their pages. The time
+    # window makes pages carrying a CSRF token expire before the token does.
+    followed = ','.join(str(id) for id in sorted(g.user.followed_ids()))
+    return [g.user.id, g.user.username, g.user.email_hash,
+            crc32(followed.encode('utf-8')),
+            int(time.time() // ETAG_CSRF_WINDOW)]
+
+
+def index_version():
+    if not g.user.is_authenticated:
+        return None
+    return page_etag('index', request.full_path,
+                     g.user.timeline_version()[0],
+                     g.user.followed_profiles_version(), *viewer_version())
+
+
+def user_version(username):
+    user = User.query.filter_by(username=username).first()
+    if user is None:
+        return None
+    return page_etag('user', request.full_path,
+                     g.user.timeline_version()[0],
+                     g.user.followed_profiles_version(), user.id,
+                     user.username, user.email_hash, user.about_me,
+                     user.last_seen, user.followers_count,
+                     user.following_count, *viewer_version())
+
+
+def search_results_version(query):
+    return page_etag('search', request.full_path, search_generation(),
+                     User.profiles_version(), *viewer_version())
+
+
 @app.route('/', methods=['GET', 'POST'])
 @app.route('/index', methods=['GET', 'POST'])
-@app.route('/index/<int:page>', methods=['GET', 'POST'])
-def index(page=1):
+@read_only
+@conditional(index_version)
+def index():
     form = PostForm()
     if form.validate_on_submit():
         post = Post(body=form.post.data, timestamp=datetime.utcnow(),
                     author=g.user)
         db.session.add(post)
+        db.session.flush()
+        post.fan_out()
         db.session.commit()
+        live_posts.publish(post.user_id, {
+            'id': post.id,
+            'author': post.author.username,
+            'body': post.body,
+            'timestamp': post.timestamp.strftime('%Y-%m-%dT%H:%M:%SZ')})
         flash('Your post is now live!')
         return redirect(url_for('index'))
     if g.user.is_authenticated:
-        posts = g.user.followed_posts().paginate(page,
-                                                 POSTS_PER_PAGE_INDEX, False)
+        posts = paginate(g.user.followed_posts(), POSTS_PER_PAGE_INDEX,
+                         before=request.args.get('before'),
+                         after=request.args.get('after'))
     else:
         posts = []
     return render_template('index.html',
@@ -52,6 +100,36 @@ def index(page=1):
                            posts=posts)
 
 
+@app.route('/live')
+@login_required
+def live():
+    # Server-Sent Events for new posts by followed users. Nothing here
+    # touches the database once streaming starts, and connections are
+    # closed after LIVE_MAX_DURATION seconds (the browser reconnects), so an
+    # idle listener costs a blocked greenlet or thread and a small queue.
+    followed_ids = list(g.user.followed_ids())
+
+    def events():
+        # subscribed in here: a response closed before its first chunk (a
+        # HEAD, or a client gone already) never runs the finally below
+        subscription = live_posts.subscribe(followed_ids)
+        try:
+            yield 'retry: %d\n\n' % LIVE_RETRY
+            deadline = time.time() + LIVE_MAX_DURATION
+            while time.time() < deadline:
+                message = subscription.get(LIVE_HEARTBEAT)
+                if message is None:
+                    yield ': keep-alive\n\n'
+                else:
+                    yield 'id: %d\nevent: post\ndata: %s\n\n' % \
+                        (message['id'], json.dumps(message))
+        finally:
+            subscription.close()
+    return Response(events(), mimetype='text/event-stream',
+                    headers={'Cache-Control': 'no-cache',
+                             'X-Accel-Buffering': 'no'})
+
+
 @app.errorhandler(404)
 def not_found_error(error):
     return render_template('404.html'), 404
@@ -167,15 +245,17 @@ def profile():
 
 
 @app.route('/user/<username>')
-@app.route('/user/<username>/<int:page>')
 @login_required
-def user(username, page=1):
+@read_only
+@conditional(user_version)
+def user(username):
     user = User.query.filter_by(username=username).first()
     if user is None:
         flash('User %s not found.' % username)
         return redirect(url_for('index'))
-    posts = g.user.followed_posts().paginate(page,
-                                             POSTS_PER_PAGE_PROFILE, False)
+    posts = paginate(g.user.followed_posts(), POSTS_PER_PAGE_PROFILE,
+                     before=request.args.get('before'),
+                     after=request.args.get('after'))
     return render_template('user.html', user=user, posts=posts)
 
 
@@ -190,11 +270,13 @@ def edit():
             if form.about_me.data is not None and form.about_me.data != '':
                 g.user.about_me = form.about_me.data
             if form.email.data is not None and form.email.data != '':
-                g.user.email = form.email.data
+                g.user.set_email(form.email.data)
             if form.password.data is not None and form.password.data != '':
                 g.user.set_password(form.password.data)
+            g.user.profile_updated = datetime.utcnow()
             db.session.add(g.user)
             db.session.commit()
+            User.forget(g.user.id)
             flash('Your profile has been updated.')
             return redirect(url_for('profile'))
         else:
@@ -254,8 +336,11 @@ def search():
 
 @app.route('/search_results/<query>')
 @login_required
+@read_only
+@conditional(search_results_version)
 def search_results(query):
-    results = Post.query.whoosh_search(query, MAX_SEARCH_RESULTS).all()
+    page = max(request.args.get('page', 1, type=int), 1)
+    results = search_posts(query, page, SEARCH_RESULTS_PER_PAGE)
     return render_template('search_results.html',
                            query=query,
                            results=results)
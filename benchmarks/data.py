@@ -0,0 +1,79 @@
+"""Synthetic users, follows and posts built through the app's models.
+
+Who gets followed follows a power law: user i is picked with weight
+1 / (i + 1) ** alpha, so a handful of users end up with most followers,
+like on a real site.
+"""
+import random
+from datetime import datetime, timedelta
+from werkzeug.security import generate_password_hash
+from app import db
+from app.models import User, Post
+
+PASSWORD = 'benchmark'
+WORDS = ('python', 'flask', 'sqlite', 'timeline', 'follow', 'search',
+         'cache', 'index', 'query', 'template', 'coffee', 'weekend',
+         'release', 'deploy', 'bug', 'fix', 'review', 'music', 'travel',
+         'morning')
+
+
+def username(i):
+    return 'User%d' % i
+
+
+def weighted_picker(rng, n, alpha):
+    weights = [1.0 / (i + 1) ** alpha for i in range(n)]
+    total = 0.0
+    cumulative = []
+    for weight in weights:
+        total += weight
+        cumulative.append(total)
+
+    def pick():
+        x = rng.random() * total
+        low, high = 0, n - 1
+        while low < high:
+            middle = (low + high) // 2
+            if cumulative[middle] < x:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+    return pick
+
+
+def generate(users=1000, posts=10000, follows=20, alpha=1.2, seed=0,
+             batch=500):
+    rng = random.Random(seed)
+    pwdhash = generate_password_hash(PASSWORD)
+    people = []
+    for i in range(users):
+        user = User(username(i), '%s@example.com' % username(i).lower())
+        user.pwdhash = pwdhash
+        people.append(user)
+        db.session.add(user)
+    db.session.commit()
+
+    pick = weighted_picker(rng, users, alpha)
+    for n, user in enumerate(people):
+        user.follow(user)
+        for _ in range(rng.randint(1, 2 * follows)):
+            user.follow(people[pick()])
+        if n % batch == 0:
+            db.session.commit()
+    db.session.commit()
+
+    start = datetime.utcnow() - timedelta(days=30)
+    step = timedelta(days=30) / max(posts, 1)
+    for n in range(posts):
+        post = Post(body=' '.join(rng.choice(WORDS)
+                                  for _ in range(rng.randint(3, 12))),
+                    timestamp=start + step * n,
+                    author=people[rng.randrange(users)])
+        db.session.add(post)
+        db.session.flush()
+        post.fan_out()
+        if n % batch == 0:
+            db.session.commit()
+    db.session.commit()
+    return people
@@ -0,0 +1,247 @@
+"""Latency, query and allocation benchmarks of the microblog hot paths.
+
+Builds a synthetic data set (see benchmarks/data.py) in its own database,
+then requests the timeline, profile, search and follow views through the
+test client and reports p50/p99 latency, queries per request and memory
+allocated per request. Results are written as JSON so runs on different
+commits can be compared:
+
+    python -m benchmarks.hot_paths --output before.json
+    python -m benchmarks.hot_paths --output after.json --compare before.json
+
+The app is imported only once the database path is known, so that its
+search index and indexing spill files can be put next to the database
+rather than in the app's own.
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import platform
+import subprocess
+import tracemalloc
+from datetime import datetime
+from sqlalchemy import event
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def percentile(values, p):
+    values = sorted(values)
+    if not values:
+        return None
+    index = int(round(p / 100.0 * (len(values) - 1)))
+    return values[index]
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', '--short', 'HEAD'], cwd=basedir,
+            stderr=subprocess.DEVNULL).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Scenario(object):
+    # One benchmarked request. `setup` runs untimed before each request,
+    # e.g. to undo a follow so the next one does real work.
+
+    def __init__(self, name, url, setup=None):
+        self.name = name
+        self.url = url
+        self.setup = setup
+
+    def request(self, client, probe=None):
+        if self.setup is not None:
+            self.setup(client)
+        if probe is None:
+            rv = client.get(self.url)
+        else:
+            with probe:
+                rv = client.get(self.url)
+        if rv.status_code >= 400:
+            raise RuntimeError('%s returned %d' % (self.url, rv.status_code))
+
+
+class LatencyProbe(object):
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.timings = []
+        self.queries = []
+        self.active = False
+        event.listen(engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        if self.active:
+            self.queries[-1] += 1
+
+    def __enter__(self):
+        self.queries.append(0)
+        self.active = True
+        self.start = time.perf_counter()
+
+    def __exit__(self, *exc_info):
+        self.timings.append((time.perf_counter() - self.start) * 1000)
+        self.active = False
+
+    def close(self):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+
+class AllocationProbe(object):
+    # Tracing slows every allocation down, so this runs in its own pass
+    # rather than alongside LatencyProbe.
+
+    def __init__(self):
+        self.peaks = []
+        self.retained = []
+        tracemalloc.start()
+
+    def __enter__(self):
+        tracemalloc.clear_traces()
+
+    def __exit__(self, *exc_info):
+        current, peak = tracemalloc.get_traced_memory()
+        self.peaks.append(peak / 1024.0)
+        self.retained.append(current / 1024.0)
+
+    def close(self):
+        tracemalloc.stop()
+
+
+def scenarios():
+    from benchmarks.data import username, WORDS
+    popular = username(0)
+    return [
+        Scenario('index', '/index'),
+        Scenario('user', '/user/%s' % popular),
+        Scenario('search_results', '/search_results/%s' % WORDS[0]),
+        Scenario('follow', '/follow/%s' % popular,
+                 setup=lambda client: client.get('/unfollow/%s' % popular)),
+    ]
+
+
+def measure(client, scenario, requests, warmup):
+    from app import db
+    for _ in range(warmup):
+        scenario.request(client)
+    latency = LatencyProbe(db.engine)
+    try:
+        for _ in range(requests):
+            scenario.request(client, latency)
+    finally:
+        latency.close()
+    allocations = AllocationProbe()
+    try:
+        for _ in range(requests):
+            scenario.request(client, allocations)
+    finally:
+        allocations.close()
+    return {
+        'requests': requests,
+        'p50_ms': percentile(latency.timings, 50),
+        'p99_ms': percentile(latency.timings, 99),
+        'mean_ms': sum(latency.timings) / len(latency.timings),
+        'queries_per_request': sum(latency.queries) / float(requests),
+        'alloc_peak_kb': percentile(allocations.peaks, 50),
+        'alloc_retained_kb': percentile(allocations.retained, 50),
+    }
+
+
+def use_search_files(database):
+    # must run before the app is imported, config.py reads these
+    os.environ['WHOOSH_BASE'] = database + '.whoosh'
+    os.environ['SEARCH_INDEX_SPILL'] = database + '.search_queue.jsonl'
+
+
+def prepare(database, users, posts, follows, seed):
+    from app import app, db, mail
+    from app.search import index_queue, post_index, reindex
+    from benchmarks.data import generate
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + database
+    app.config['WTF_CSRF_ENABLED'] = False
+    # follow() sends notification emails, keep them off the network
+    app.extensions['mail'] = mail.init_mail({'MAIL_SUPPRESS_SEND': True})
+    with app.test_request_context():
+        if not os.path.exists(database):
+            db.create_all()
+            generate(users=users, posts=posts, follows=follows, seed=seed)
+        index_queue.flush()
+        if post_index().doc_count() == 0:
+            reindex(procs=1)
+        db.session.remove()
+
+
+def report(results, baseline=None):
+    columns = ('p50_ms', 'p99_ms', 'queries_per_request', 'alloc_peak_kb')
+    print('%-16s' % 'scenario' + ''.join('%22s' % c for c in columns))
+    for name, result in results.items():
+        line = '%-16s' % name
+        for column in columns:
+            cell = '%.2f' % result[column]
+            if baseline is not None and name in baseline and \
+                    baseline[name][column]:
+                change = (result[column] - baseline[name][column]) / \
+                    baseline[name][column] * 100
+                cell += ' (%+.0f%%)' % change
+            line += '%22s' % cell
+        print(line)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--posts', type=int, default=10000)
+    parser.add_argument('--follows', type=int, default=20,
+                        help='average number of users each user follows')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--requests', type=int, default=200)
+    parser.add_argument('--warmup', type=int, default=20)
+    parser.add_argument('--database', default=None,
+                        help='reused when it exists, generated otherwise')
+    parser.add_argument('--output', default=None)
+    parser.add_argument('--compare', default=None,
+                        help='an earlier --output file to compare against')
+    args = parser.parse_args()
+
+    database = os.path.abspath(args.database or os.path.join(
+        basedir, 'tmp', 'benchmark-%d-%d-%d-%d.db' % (
+            args.users, args.posts, args.follows, args.seed)))
+    os.makedirs(os.path.dirname(database), exist_ok=True)
+    use_search_files(database)
+    prepare(database, args.users, args.posts, args.follows, args.seed)
+
+    from app import app
+    from benchmarks.data import username, PASSWORD
+    client = app.test_client()
+    rv = client.post('/login', data={
+        'email': '%s@example.com' % username(1).lower(),
+        'password': PASSWORD})
+    if rv.status_code != 302:
+        sys.exit('could not log in as %s' % username(1))
+    results = {}
+    for scenario in scenarios():
+        results[scenario.name] = measure(client, scenario, args.requests,
+                                         args.warmup)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)['results']
+    report(results, baseline)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({
+                'commit': git_commit(),
+                'date': datetime.utcnow().isoformat(),
+                'python': platform.python_version(),
+                'parameters': vars(args),
+                'results': results,
+            }, f, indent=2, sort_keys=True)
+
+
+if __name__ == '__main__':
+    main()
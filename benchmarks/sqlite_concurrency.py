@@ -0,0 +1,120 @@
+"""Read throughput of the SQLite engine while a writer commits continuously.
+
+Runs the same workload against the default SQLite settings and against the
+SQLITE_* settings in config.py and prints reads per second and the number of
+"database is locked" errors for each.
+
+    python -m benchmarks.sqlite_concurrency --readers 8 --seconds 10
+"""
+import os
+import time
+import argparse
+import tempfile
+import threading
+from datetime import datetime
+from sqlalchemy import create_engine, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.pool import QueuePool
+import config
+from app.database import sqlite_connector
+
+DEFAULTS = {
+    'SQLITE_JOURNAL_MODE': 'DELETE',
+    'SQLITE_SYNCHRONOUS': 'FULL',
+    'SQLITE_MMAP_SIZE': 0,
+    'SQLITE_BUSY_TIMEOUT': 0,
+}
+TUNED = dict((key, getattr(config, key)) for key in DEFAULTS)
+
+
+def make_engine(path, settings, readers):
+    return create_engine('sqlite://', creator=sqlite_connector(path, settings),
+                         poolclass=QueuePool, pool_size=readers + 1,
+                         max_overflow=0)
+
+
+def setup(engine, rows):
+    with engine.begin() as connection:
+        connection.execute(text(
+            'CREATE TABLE post (id INTEGER PRIMARY KEY, body VARCHAR(140), '
+            'timestamp DATETIME, user_id INTEGER)'))
+        connection.execute(text(
+            'CREATE INDEX ix_post_user_id ON post (user_id)'))
+        connection.execute(
+            text('INSERT INTO post (body, timestamp, user_id) '
+                 'VALUES (:body, :timestamp, :user_id)'),
+            [{'body': 'post %d' % i, 'timestamp': datetime.utcnow(),
+              'user_id': i % 100} for i in range(rows)])
+
+
+def run(settings, readers, seconds, rows):
+    fd, path = tempfile.mkstemp(suffix='.db')
+    os.close(fd)
+    engine = make_engine(path, settings, readers)
+    setup(engine, rows)
+    stop = threading.Event()
+    counts = {'reads': 0, 'writes': 0, 'locked': 0}
+    lock = threading.Lock()
+
+    def count(key):
+        with lock:
+            counts[key] += 1
+
+    def reader(n):
+        while not stop.is_set():
+            try:
+                with engine.connect() as connection:
+                    connection.execute(text(
+                        'SELECT id, body FROM post WHERE user_id = :user_id '
+                        'ORDER BY id DESC LIMIT 20'),
+                        user_id=n % 100).fetchall()
+                count('reads')
+            except OperationalError:
+                count('locked')
+
+    def writer():
+        i = 0
+        while not stop.is_set():
+            try:
+                with engine.begin() as connection:
+                    connection.execute(
+                        text('INSERT INTO post (body, timestamp, user_id) '
+                             'VALUES (:body, :timestamp, :user_id)'),
+                        body='new post %d' % i, timestamp=datetime.utcnow(),
+                        user_id=i % 100)
+                count('writes')
+            except OperationalError:
+                count('locked')
+            i += 1
+
+    threads = [threading.Thread(target=reader, args=(n,))
+               for n in range(readers)]
+    threads.append(threading.Thread(target=writer))
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    engine.dispose()
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+    return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--readers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--rows', type=int, default=10000)
+    args = parser.parse_args()
+    for name, settings in (('default', DEFAULTS), ('tuned', TUNED)):
+        counts = run(settings, args.readers, args.seconds, args.rows)
+        print('%-8s %10.1f reads/s %8.1f writes/s %6d locked' % (
+            name, counts['reads'] / args.seconds,
+            counts['writes'] / args.seconds, counts['locked']))
+
+
+if __name__ == '__main__':
+    main()
@@ -3,6 +3,9 @@ import secrets
 from datetime import timedelta
 
 WTF_CSRF_ENABLED = True
+# pages answered with 304 Not Modified are re-rendered at least this often
+# (seconds), so the CSRF tokens in them never outlive WTF_CSRF_TIME_LIMIT
+ETAG_CSRF_WINDOW = 1800
 SECRET_KEY = secrets.SECRET_KEY
 REMEMBER_COOKIE_DURATION = timedelta(days=365)
 
@@ -11,6 +14,27 @@ basedir = os.path.abspath(os.path.dirname(__file__))
 SQLALCHEMY_DATABASE_URI = 'sqlite:///' + os.path.join(basedir, 'app.db')
 SQLALCHEMY_MIGRATE_REPO = os.path.join(basedir, 'db_repository')
 
+# read-only views are served from this copy of the database when it is set,
+# except for REPLICA_STICKY_WINDOW seconds after the visitor wrote something
+SQLALCHEMY_BINDS = {}
+if os.environ.get('REPLICA_DATABASE_URL'):
+    SQLALCHEMY_BINDS['replica'] = os.environ['REPLICA_DATABASE_URL']
+REPLICA_STICKY_WINDOW = 10
+
+# SQLite connection settings: WAL lets readers run alongside a writer,
+# busy_timeout (milliseconds) makes writers wait for the lock instead of
+# failing with "database is locked"
+SQLITE_JOURNAL_MODE = 'WAL'
+SQLITE_SYNCHRONOUS = 'NORMAL'
+SQLITE_MMAP_SIZE = 256 * 1024 * 1024
+SQLITE_BUSY_TIMEOUT = 5000
+SQLITE_POOL_SIZE = 5
+SQLITE_POOL_OVERFLOW = 10
+SQLITE_POOL_TIMEOUT = 30
+
+# compiled Jinja templates, filled by 'manage.py compile_templates'
+TEMPLATE_CACHE_DIR = os.path.join(basedir, 'tmp', 'jinja_cache')
+
 OAUTH_CREDENTIALS = secrets.OAUTH_CREDENTIALS
 
 # mail server settings
@@ -21,13 +45,133 @@ MAIL_USE_SSL = True
 MAIL_USERNAME = secrets.MAIL_USERNAME
 MAIL_PASSWORD = secrets.MAIL_PASSWORD
 
+# outgoing mail is sent by MAIL_WORKERS threads reusing one SMTP connection
+# for up to MAIL_BATCH_SIZE queued messages; senders wait up to
+# MAIL_QUEUE_TIMEOUT seconds when MAIL_QUEUE_SIZE messages are already queued
+MAIL_WORKERS = 2
+MAIL_QUEUE_SIZE = 1000
+MAIL_QUEUE_TIMEOUT = 5
+MAIL_BATCH_SIZE = 50
+# at exit, wait up to MAIL_EXIT_TIMEOUT seconds for queued mail to go out
+MAIL_EXIT_TIMEOUT = 10
+# keep queued mail in the outbox table so it survives restarts
+MAIL_OUTBOX = False
+MAIL_OUTBOX_CLAIM_TIMEOUT = timedelta(minutes=10)
+
+# follow notifications are batched into one digest per followed user every
+# FOLLOW_DIGEST_WINDOW seconds, naming up to FOLLOW_DIGEST_NAMES followers
+# (batched in each process, so with several workers a user can get one
+# digest per worker and window)
+FOLLOW_DIGEST_WINDOW = 300
+FOLLOW_DIGEST_NAMES = 2
+
 # administrator list
 ADMINS = secrets.ADMINS
 
+# last_seen updates are buffered and written in bulk every
+# LAST_SEEN_FLUSH_INTERVAL seconds, and skipped while the stored value is
+# younger than LAST_SEEN_THROTTLE
+LAST_SEEN_FLUSH_INTERVAL = 30
+LAST_SEEN_THROTTLE = timedelta(minutes=1)
+
 # pagination
 POSTS_PER_PAGE_INDEX = 3
 POSTS_PER_PAGE_PROFILE = 5
 
-# WHOOSH database
-WHOOSH_BASE = os.path.join(basedir, 'search.db')
+# timelines: posts by authors with at least this many followers are merged
+# into timelines at read time instead of being fanned out on write
+# (None fans out every post)
+TIMELINE_FANOUT_LIMIT = 1000
+
+# cache the logged in user's row in each process for USER_CACHE_TTL
+# seconds (0 looks the user up on every request)
+USER_CACHE_SIZE = 1024
+USER_CACHE_TTL = 0
+
+# keep each user's followed ids in memory across requests (invalidated on
+# follow/unfollow in this process only, so single-process deployments only),
+# for up to SHARED_FOLLOW_SET_CACHE_SIZE users and
+# SHARED_FOLLOW_SET_CACHE_TTL seconds
+SHARED_FOLLOW_SET_CACHE = False
+SHARED_FOLLOW_SET_CACHE_SIZE = 10000
+SHARED_FOLLOW_SET_CACHE_TTL = 300
+
+# how post authors are eager loaded with timelines and search results:
+# 'joined', 'subquery' or 'selectin' (SQLAlchemy >= 1.2)
+POST_AUTHOR_LOADING = 'joined'
+
+# rendered posts are cached per post, author and NOW_BUCKET (their relative
+# times move on): 'local' keeps them in each process, 'memcached' shares them
+# between processes via FRAGMENT_CACHE_SERVERS and 'simple' is werkzeug's
+# in-process stand-in
+FRAGMENT_CACHE_BACKEND = 'local'
+FRAGMENT_CACHE_SIZE = 10000
+FRAGMENT_CACHE_TTL = 300
+FRAGMENT_CACHE_SERVERS = ['127.0.0.1:11211']
+
+# JSON API paging; ?stream=1 responses are read API_STREAM_CHUNK rows at a
+# time. Each stream holds a pooled connection until it ends, so a process
+# serves at most API_MAX_STREAMS at once (keep it below SQLITE_POOL_SIZE)
+# and answers 503 beyond that
+API_PAGE_SIZE = 20
+API_MAX_PAGE_SIZE = 100
+API_STREAM_CHUNK = 100
+API_MAX_STREAMS = 4
+
+# live timeline updates: 'local' delivers within one process, 'redis'
+# shares them between processes through LIVE_REDIS_URL. Connections are
+# recycled every LIVE_MAX_DURATION seconds, with a keep-alive comment every
+# LIVE_HEARTBEAT seconds and LIVE_RETRY milliseconds between reconnects.
+LIVE_BACKEND = 'local'
+LIVE_REDIS_URL = 'redis://localhost:6379/0'
+LIVE_QUEUE_SIZE = 100
+LIVE_HEARTBEAT = 15
+LIVE_MAX_DURATION = 300
+LIVE_RETRY = 3000
+
+# WHOOSH database; it and the indexing spill files below can be moved with
+# environment variables of the same names
+WHOOSH_BASE = os.environ.get('WHOOSH_BASE',
+                             os.path.join(basedir, 'search.db'))
 MAX_SEARCH_RESULTS = 50
+SEARCH_RESULTS_PER_PAGE = 10
+# ranked result ids are cached per query until the index changes
+SEARCH_CACHE_SIZE = 256
+SEARCH_CACHE_TTL = 300
+# new and changed posts are indexed in the background, in one Whoosh commit
+# per SEARCH_INDEX_BATCH posts or SEARCH_INDEX_INTERVAL seconds; queued
+# changes are spilled to a per-process file named after SEARCH_INDEX_SPILL
+# until they are committed. A commit waits up to SEARCH_INDEX_LOCK_TIMEOUT
+# seconds for another process' writer, then retries on the next interval
+SEARCH_INDEX_BATCH = 100
+SEARCH_INDEX_INTERVAL = 0.5
+SEARCH_INDEX_LOCK_TIMEOUT = 2
+SEARCH_INDEX_SPILL = os.environ.get(
+    'SEARCH_INDEX_SPILL',
+    os.path.join(basedir, 'tmp', 'search_queue.jsonl'))
+
+# per endpoint request, SQL and template timings served at /_metrics to
+# METRICS_ALLOWED_IPS; SERVER_TIMING also sends them in a Server-Timing
+# header for the browser's developer tools
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+METRICS_LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0,
+                           2.5, 5.0, 10.0)
+METRICS_QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+SERVER_TIMING = False
+
+# sampling profiler, off unless PROFILE_ENABLED: requests slower than
+# PROFILE_THRESHOLD seconds, plus a PROFILE_SAMPLE_RATE fraction of all
+# requests, have their stacks sampled every PROFILE_INTERVAL seconds written
+# to PROFILE_DIR as collapsed stacks (see manage.py profile_report)
+PROFILE_ENABLED = False
+PROFILE_THRESHOLD = 1.0
+PROFILE_SAMPLE_RATE = 0.0
+PROFILE_INTERVAL = 0.005
+PROFILE_DIR = os.path.join(basedir, 'tmp', 'profiles')
+
+# statements slower than SLOW_QUERY_THRESHOLD seconds are logged to
+# SLOW_QUERY_LOG with their query plan, once per statement shape; repeats
+# of a shape are only counted (SLOW_QUERY_SHAPES are remembered)
+SLOW_QUERY_THRESHOLD = 0.1
+SLOW_QUERY_LOG = os.path.join(basedir, 'tmp', 'slow_queries.log')
+SLOW_QUERY_SHAPES = 1000
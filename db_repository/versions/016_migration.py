@@ -0,0 +1,33 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+timeline = Table('timeline', post_meta,
+    Column('owner_id', Integer, primary_key=True, nullable=False),
+    Column('post_id', Integer, primary_key=True, nullable=False),
+    Column('author_id', Integer),
+    Column('timestamp', DateTime),
+    Index('ix_timeline_owner_timestamp', 'owner_id', 'timestamp'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['timeline'].create()
+    migrate_engine.execute(
+        'INSERT INTO timeline (owner_id, post_id, author_id, timestamp) '
+        'SELECT followers.follower_id, post.id, post.user_id, post.timestamp '
+        'FROM followers JOIN post ON followers.followed_id = post.user_id')
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['timeline'].drop()
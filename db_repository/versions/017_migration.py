@@ -0,0 +1,37 @@
+from sqlalchemy import *
+from migrate import *
+from hashlib import md5
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('username', String(length=64)),
+    Column('email', String(length=64), nullable=False),
+    Column('email_hash', String(length=32)),
+    Column('pwdhash', String(length=64)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    user = post_meta.tables['user']
+    user.columns['email_hash'].create()
+    rows = migrate_engine.execute(select([user.c.id, user.c.email])).fetchall()
+    for id, email in rows:
+        migrate_engine.execute(user.update().where(user.c.id == id).values(
+            email_hash=md5(email.encode('utf-8')).hexdigest()))
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['email_hash'].drop()
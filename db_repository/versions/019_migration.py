@@ -0,0 +1,29 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+outbox_message = Table('outbox_message', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('payload', Text),
+    Column('claimed_by', String(length=32)),
+    Column('claimed_at', DateTime),
+    Index('ix_outbox_message_claimed_by', 'claimed_by'),
+)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['outbox_message'].create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['outbox_message'].drop()
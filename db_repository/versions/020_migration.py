@@ -0,0 +1,62 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+followers = Table('followers', pre_meta,
+    Column('follower_id', Integer),
+    Column('followed_id', Integer),
+)
+
+followers = Table('followers', post_meta,
+    Column('follower_id', Integer, primary_key=True, nullable=False),
+    Column('followed_id', Integer, primary_key=True, nullable=False),
+    Index('ix_followers_followed_id', 'followed_id', 'follower_id'),
+)
+
+post = Table('post', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('body', String(length=140)),
+    Column('timestamp', DateTime),
+    Column('user_id', Integer),
+)
+
+ix_post_user_timestamp = Index('ix_post_user_timestamp', post.c.user_id,
+                               post.c.timestamp.desc(), post.c.id)
+
+
+def copy_followers(migrate_engine, table):
+    # SQLite can't add a primary key to an existing table, so the table is
+    # rebuilt; DISTINCT drops the duplicate rows the old table allowed
+    migrate_engine.execute('ALTER TABLE followers RENAME TO followers_old')
+    table.create()
+    migrate_engine.execute(
+        'INSERT INTO followers (follower_id, followed_id) '
+        'SELECT DISTINCT follower_id, followed_id FROM followers_old '
+        'WHERE follower_id IS NOT NULL AND followed_id IS NOT NULL')
+    migrate_engine.execute('DROP TABLE followers_old')
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    copy_followers(migrate_engine, post_meta.tables['followers'])
+    ix_post_user_timestamp.create()
+    migrate_engine.execute(
+        'UPDATE user SET '
+        'followers_count = (SELECT count(*) FROM followers '
+        'WHERE followers.followed_id = user.id), '
+        'following_count = (SELECT count(*) FROM followers '
+        'WHERE followers.follower_id = user.id)')
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    ix_post_user_timestamp.drop()
+    copy_followers(migrate_engine, pre_meta.tables['followers'])
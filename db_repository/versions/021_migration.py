@@ -0,0 +1,38 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+timeline = Table('timeline', pre_meta,
+    Column('owner_id', Integer, primary_key=True, nullable=False),
+    Column('post_id', Integer, primary_key=True, nullable=False),
+    Column('author_id', Integer),
+    Column('timestamp', DateTime),
+)
+
+ix_timeline_owner_timestamp = Index('ix_timeline_owner_timestamp',
+                                    timeline.c.owner_id,
+                                    timeline.c.timestamp)
+ix_timeline_owner_timestamp_post = Index('ix_timeline_owner_timestamp_post',
+                                         timeline.c.owner_id,
+                                         timeline.c.timestamp,
+                                         timeline.c.post_id)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    ix_timeline_owner_timestamp_post.create()
+    ix_timeline_owner_timestamp.drop()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    ix_timeline_owner_timestamp.create()
+    ix_timeline_owner_timestamp_post.drop()
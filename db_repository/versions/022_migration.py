@@ -0,0 +1,39 @@
+from sqlalchemy import *
+from migrate import *
+
+
+from migrate.changeset import schema
+pre_meta = MetaData()
+post_meta = MetaData()
+user = Table('user', post_meta,
+    Column('id', Integer, primary_key=True, nullable=False),
+    Column('username', String(length=64)),
+    Column('email', String(length=64), nullable=False),
+    Column('email_hash', String(length=32)),
+    Column('pwdhash', String(length=64)),
+    Column('about_me', String(length=140)),
+    Column('last_seen', DateTime),
+    Column('followers_count', Integer, default=ColumnDefault(0)),
+    Column('following_count', Integer, default=ColumnDefault(0)),
+    Column('profile_updated', DateTime),
+)
+
+ix_user_profile_updated = Index('ix_user_profile_updated',
+                                user.c.profile_updated)
+
+
+def upgrade(migrate_engine):
+    # Upgrade operations go here. Don't create your own engine; bind
+    # migrate_engine to your metadata
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    post_meta.tables['user'].columns['profile_updated'].create()
+    ix_user_profile_updated.create()
+
+
+def downgrade(migrate_engine):
+    # Operations to reverse the above upgrade go here.
+    pre_meta.bind = migrate_engine
+    post_meta.bind = migrate_engine
+    ix_user_profile_updated.drop()
+    post_meta.tables['user'].columns['profile_updated'].drop()
@@ -1,6 +1,13 @@
+import os
+from datetime import datetime
 from flask import url_for
 from flask.ext.script import Manager
-from app import app
+from app import app, db
+from app.models import User, Post, followers
+from app.pagination import keyset_parts, keyset_range
+from app.profiler import load_profiles, hot_frames
+from config import PROFILE_DIR
+from app.search import reindex as reindex_posts
 
 
 manager = Manager(app)
@@ -25,5 +32,95 @@ def list_routes():
     for line in sorted(output):
         print(line)
 
+
+@manager.command
+def compile_templates():
+    """Compile all templates into the Jinja bytecode cache."""
+    names = app.jinja_env.list_templates()
+    for name in names:
+        app.jinja_env.get_template(name)
+    print('Compiled %d templates.' % len(names))
+
+
+@manager.command
+def recount_follows():
+    """Recompute every user's cached follower and following counts."""
+    User.recount_follows()
+    db.session.commit()
+    print('Follow counts recomputed.')
+
+
+@manager.option('-p', '--procs', dest='procs', type=int, default=4)
+@manager.option('-c', '--chunk-size', dest='chunk_size', type=int,
+                default=1000)
+def reindex(procs, chunk_size):
+    """Rebuild the post search index from the post table."""
+    indexed = reindex_posts(procs=procs, chunk_size=chunk_size)
+    print('Indexed %d posts.' % indexed)
+
+
+@manager.command
+def rebuild_timelines():
+    """Repopulate every home timeline from the followers table."""
+    User.rebuild_timelines()
+    db.session.commit()
+    print('Timelines rebuilt.')
+
+
+@manager.option('-u', '--username', dest='username', default=None)
+def explain_hot_queries(username):
+    """Print the SQLite query plans of the timeline and follow queries."""
+    if username is None:
+        user = User.query.first()
+    else:
+        user = User.query.filter_by(username=username).first()
+    if user is None:
+        print('No user to build the queries for.')
+        return
+    # a cursor, so the plans are those of a page past the first
+    cursor = (datetime.utcnow(), 2 ** 31)
+    queries = [('followed_posts part %d' % n,
+                keyset_range(part, timestamp, id, cursor).limit(20))
+               for n, (part, timestamp, id) in
+               enumerate(keyset_parts(user.followed_posts()))]
+    queries += [
+        ('user posts', keyset_range(Post.query.filter(
+            Post.user_id == user.id), Post.timestamp, Post.id,
+            cursor).limit(20)),
+        ('followed ids', db.session.query(followers.c.followed_id)
+            .filter(followers.c.follower_id == user.id)),
+        ('follower ids', db.session.query(followers.c.follower_id)
+            .filter(followers.c.followed_id == user.id)),
+    ]
+    for name, query in queries:
+        compiled = query.statement.compile(dialect=db.engine.dialect)
+        params = tuple(compiled.params[key] for key in compiled.positiontup)
+        print('%s:' % name)
+        for row in db.engine.execute('EXPLAIN QUERY PLAN ' + str(compiled),
+                                     params):
+            print('    %s' % row[-1])
+        print('')
+
+
+@manager.option('-e', '--endpoint', dest='endpoint', default=None)
+@manager.option('-n', '--top', dest='top', type=int, default=20)
+def profile_report(endpoint, top):
+    """Merge the recorded request profiles and show the busiest frames."""
+    files, samples = load_profiles(PROFILE_DIR, endpoint)
+    if not files:
+        print('No profiles in %s.' % PROFILE_DIR)
+        return
+    merged = os.path.join(PROFILE_DIR, 'merged.folded')
+    with open(merged, 'w') as f:
+        for stack, count in samples.most_common():
+            f.write('%s %d\n' % (stack, count))
+    total = sum(samples.values())
+    print('%d profiles, %d samples, merged into %s' % (files, total, merged))
+    print('')
+    print('%7s %7s  %s' % ('self', 'total', 'frame'))
+    for name, own, inclusive in hot_frames(samples, top):
+        print('%6.1f%% %6.1f%%  %s' % (own * 100.0 / total,
+                                       inclusive * 100.0 / total, name))
+
 if __name__ == "__main__":
     manager.run()
@@ -1,3 +1,20 @@
 #!/home/pj/.conda/envs/flask-microblog/bin/python
+try:
+    # with gevent, every live timeline listener is a cheap greenlet instead
+    # of a server thread; the patching has to happen before anything else
+    from gevent import monkey
+    monkey.patch_all()
+    from gevent.pywsgi import WSGIServer
+except ImportError:
+    WSGIServer = None
 from app import app
-app.run(debug=False, host='0.0.0.0')
+# templates don't change under a running production server
+app.jinja_env.auto_reload = False
+if WSGIServer is not None:
+    WSGIServer(('0.0.0.0', 5000), app).serve_forever()
+else:
+    app.logger.warning(
+        'gevent is not installed: every /live listener holds a server '
+        'thread for up to %d seconds (LIVE_MAX_DURATION)',
+        app.config['LIVE_MAX_DURATION'])
+    app.run(debug=False, host='0.0.0.0', threaded=True)
@@ -1,18 +1,115 @@
 #!/home/pj/.conda/envs/flask-microblog/bin/python
+import atexit
+import json
 import os
+import shutil
+import smtplib
+import socketserver
+import sqlite3
+import tempfile
+import threading
+import time
 import unittest
 
-from unittest import TestCase
+# The tests get a search index and spill files of their own, set up before
+# config.py is read, so they never touch (or reindex) the developer's.
+if 'WHOOSH_BASE' not in os.environ:
+    search_dir = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, search_dir, True)
+    os.environ['WHOOSH_BASE'] = os.path.join(search_dir, 'search.db')
+    os.environ['SEARCH_INDEX_SPILL'] = os.path.join(search_dir,
+                                                    'search_queue.jsonl')
+
+from unittest import TestCase, mock
 from datetime import datetime, timedelta
+from hashlib import md5
+from threading import Thread
 from flask import url_for
+from sqlalchemy import event
 from config import basedir
-from app import app, db
-from app.models import User, Post
+from flask.ext.mail import Message
+from app import app, db, mail
+from app.models import User, Post, OutboxMessage, followers, timeline
+from app.pagination import paginate, newest_first, keyset_parts, \
+    keyset_range
+from app.lastseen import LastSeenBuffer
+from app.background import Flusher
+from app.cache import LRUCache
+from app.search import IndexQueue, index_queue, search_cache, \
+    search_posts, reindex
+from app.mailer import MailDispatcher, message_to_json
+from app.emails import FollowDigest
+from app.momentjs import momentjs
+from app.fragments import PostFragments, make_backend
+from app.live import live_posts
+from app.profiler import SamplingProfiler, load_profiles, hot_frames
+from app.slowquery import SlowQueryLog, statement_shape
+from whoosh.index import LockError
+from jinja2 import Environment, FileSystemBytecodeCache
+from manage import compile_templates
 from flask.ext.login import login_user, logout_user, current_user
 
 grav_url = 'http://www.gravatar.com/avatar/d4c74594d841139328695756648b6bd6'
 
 
+class QueryCounter(object):
+
+    def __init__(self, engine):
+        self.engine = engine
+        self.count = 0
+
+    def __enter__(self):
+        event.listen(self.engine, 'before_cursor_execute', self._count)
+        return self
+
+    def __exit__(self, *exc_info):
+        event.remove(self.engine, 'before_cursor_execute', self._count)
+
+    def _count(self, *args):
+        self.count += 1
+
+
+class SMTPStandInHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        self.server.connections += 1
+        self.wfile.write(b'220 localhost\r\n')
+        data = None
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                break
+            if data is not None:
+                if line == b'.\r\n':
+                    self.server.messages.append(b''.join(data))
+                    data = None
+                    self.wfile.write(b'250 OK\r\n')
+                else:
+                    data.append(line)
+                continue
+            command = line[:4].upper()
+            if command == b'DATA':
+                data = []
+                self.wfile.write(b'354 End data with <CR><LF>.<CR><LF>\r\n')
+            elif command == b'QUIT':
+                self.wfile.write(b'221 Bye\r\n')
+                break
+            else:
+                self.wfile.write(b'250 OK\r\n')
+
+
+class SMTPStandIn(socketserver.ThreadingTCPServer):
+    # Just enough of an SMTP server to accept mail on a local port.
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0),
+                                                 SMTPStandInHandler)
+        self.connections = 0
+        self.messages = []
+
+
 class BaseTestClass(TestCase):
 
     def setUp(self):
@@ -34,6 +131,70 @@ class BaseTestClass(TestCase):
         db.drop_all()
 
 
+class ProfilerTests(TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_slow_request_profile(self):
+        profiler = SamplingProfiler(0.001, self.directory)
+
+        def slow_view():
+            time.sleep(0.1)
+
+        profile = profiler.begin('user')
+        slow_view()
+        assert profiler.end(profile, False) is None
+        profile = profiler.begin('user')
+        slow_view()
+        path = profiler.end(profile, True)
+        assert os.path.basename(path).split('-')[1] == 'user'
+        files, samples = load_profiles(self.directory, 'user')
+        assert files == 1
+        assert load_profiles(self.directory, 'index')[0] == 0
+        name, own, total = hot_frames(samples, 1)[0]
+        assert name.startswith('slow_view ')
+
+
+class MomentTests(TestCase):
+
+    def test_server_side_times(self):
+        now = datetime(2016, 5, 4, 12, 0, 0)
+        assert '>a few seconds ago<' in \
+            momentjs(now - timedelta(seconds=10), now).fromNow()
+        assert '>5 minutes ago<' in \
+            momentjs(now - timedelta(minutes=5), now).fromNow()
+        assert '>3 days ago<' in \
+            momentjs(now - timedelta(days=3), now).fromNow()
+        assert '>Yesterday at 12:00 PM<' in \
+            momentjs(now - timedelta(days=1), now).calendar()
+        rendered = momentjs(now, now).format('MMMM Do YYYY, HH:mm')
+        assert '>May 4th 2016, 12:00<' in rendered
+        assert 'datetime="2016-05-04T12:00:00Z"' in rendered
+
+
+class TemplateCacheTests(TestCase):
+
+    def test_compile_templates(self):
+        cache_dir = tempfile.mkdtemp()
+        with mock.patch.object(app.jinja_env, 'bytecode_cache',
+                               FileSystemBytecodeCache(cache_dir)), \
+                mock.patch.object(app.jinja_env, 'cache', {}):
+            compile_templates()
+        assert len(os.listdir(cache_dir)) == \
+            len(app.jinja_env.list_templates())
+        # another worker's environment loads them instead of compiling
+        env = Environment(loader=app.jinja_env.loader,
+                          bytecode_cache=FileSystemBytecodeCache(cache_dir))
+        with mock.patch.object(Environment, 'compile',
+                               side_effect=AssertionError('compiled')):
+            assert env.get_template('post.html') is not None
+        shutil.rmtree(cache_dir)
+
+
 class UserTestClass(BaseTestClass):
 
     def create_user(self, user):
@@ -69,6 +230,95 @@ class UserTestClass(BaseTestClass):
         return self.client.get(url_for('logout'), follow_redirects=True)
 
 
+class MailTests(BaseTestClass):
+
+    def setUp(self):
+        BaseTestClass.setUp(self)
+        self.smtp = SMTPStandIn()
+        Thread(target=self.smtp.serve_forever, daemon=True).start()
+        self.mail_state = mock.patch.dict(app.extensions, {
+            'mail': mail.init_mail({'MAIL_SERVER': '127.0.0.1',
+                                    'MAIL_PORT': self.smtp.server_address[1],
+                                    'MAIL_SUPPRESS_SEND': False})})
+        self.mail_state.start()
+
+    def tearDown(self):
+        self.mail_state.stop()
+        self.smtp.shutdown()
+        self.smtp.server_close()
+        BaseTestClass.tearDown(self)
+
+    def message(self, i):
+        return Message('message %d' % i, sender='admin@example.com',
+                       recipients=['user%d@example.com' % i], body='hi')
+
+    def test_dispatcher_reuses_connection(self):
+        dispatcher = MailDispatcher(app, workers=1, queue_size=10,
+                                    batch_size=10)
+        for i in range(3):
+            assert dispatcher.submit(self.message(i))
+        dispatcher.start()
+        dispatcher.join()
+        assert len(self.smtp.messages) == 3
+        assert self.smtp.connections == 1
+
+    def test_dispatcher_backpressure(self):
+        dispatcher = MailDispatcher(app, workers=1, queue_size=1,
+                                    batch_size=10)
+        assert dispatcher.submit(self.message(0), timeout=0.01)
+        # no workers are running yet, so the queue stays full
+        assert not dispatcher.submit(self.message(1), timeout=0.01)
+
+    def test_outbox_survives_restart(self):
+        # a message queued by a process that died before sending it
+        db.session.add(OutboxMessage(payload=message_to_json(self.message(0))))
+        db.session.commit()
+        dispatcher = MailDispatcher(app, workers=1, queue_size=10,
+                                    batch_size=10, outbox=True)
+        dispatcher.submit(self.message(1))
+        assert not dispatcher.join(timeout=0.01)
+        dispatcher.start()
+        assert dispatcher.join(timeout=5)
+        assert len(self.smtp.messages) == 2
+        assert OutboxMessage.query.count() == 0
+
+    def test_outbox_releases_failed_batch(self):
+        dispatcher = MailDispatcher(app, workers=1, queue_size=10,
+                                    batch_size=10, outbox=True)
+        for i in range(2):
+            dispatcher.submit(self.message(i))
+        with mock.patch('flask_mail.Connection.send',
+                        side_effect=smtplib.SMTPServerDisconnected):
+            dispatcher.start()
+            dispatcher.join()
+        assert self.smtp.messages == []
+        db.session.remove()
+        assert [m.claimed_by for m in OutboxMessage.query] == [None, None]
+        # the next periodic reclaim sends them
+        dispatcher._reclaim()
+        dispatcher.join()
+        assert len(self.smtp.messages) == 2
+        assert OutboxMessage.query.count() == 0
+
+    def test_outbox_keeps_own_claims(self):
+        dispatcher = MailDispatcher(app, workers=1, queue_size=10,
+                                    batch_size=10, outbox=True)
+        dispatcher.submit(self.message(0))
+        # still queued here long after it was stored
+        OutboxMessage.query.update(
+            {'claimed_at': datetime.utcnow() - timedelta(days=1)})
+        db.session.commit()
+        dispatcher._reclaim()
+        assert dispatcher.queue.qsize() == 1
+        db.session.remove()
+        assert OutboxMessage.query.one().claimed_by == dispatcher.token
+        # and another process doesn't take it either
+        other = MailDispatcher(app, workers=1, queue_size=10,
+                               batch_size=10, outbox=True)
+        other._reclaim()
+        assert other.queue.qsize() == 0
+
+
 class UserTests(UserTestClass):
 
     def test_create_unique_username(self):
@@ -83,6 +333,38 @@ class UserTests(UserTestClass):
         expected = grav_url
         assert avatar[0:len(expected)] == expected
 
+    def test_email_hash(self):
+        u = User(username='john', email='john@example.com')
+        self.create_user(u)
+        assert u.email_hash == grav_url.rsplit('/', 1)[1]
+        u.set_email('susan@example.com')
+        assert not u.avatar(128).startswith(grav_url)
+        # rows written before the column existed still get their avatar
+        u.email_hash = None
+        assert u.avatar(128).startswith(
+            'http://www.gravatar.com/avatar/' +
+            md5(b'susan@example.com').hexdigest())
+
+    def test_user_cache(self):
+        u = User(username='john', email='john@example.com')
+        self.create_user(u)
+        id = u.id
+        with mock.patch('app.models.USER_CACHE_TTL', 30):
+            db.session.remove()
+            with QueryCounter(db.engine) as counter:
+                User.load(id)
+                db.session.remove()
+                user = User.load(id)
+                assert user.username == 'John'
+            assert counter.count == 1
+            # forgetting the user (as edit() does) goes back to the database
+            User.forget(id)
+            db.session.remove()
+            with QueryCounter(db.engine) as counter:
+                User.load(id)
+            assert counter.count == 1
+            User.forget(id)
+
     def test_login_and_logout(self):
         u = User(username='john', email='john@example.com', password='foobar')
         self.create_user(u)
@@ -150,6 +432,63 @@ class UserTests(UserTestClass):
         assert current_user.check_password('pharos1')
         assert current_user.about_me == 'something'
 
+    def test_last_seen_buffer(self):
+        u = User(username='john', email='john@example.com')
+        self.create_user(u)
+        buffer = LastSeenBuffer(3600, timedelta(minutes=1))
+        first = datetime.utcnow()
+        buffer.touch(u, first)
+        buffer.touch(u, first + timedelta(seconds=5))  # last write wins
+        assert User.query.get(u.id).last_seen is None
+        buffer.flush()
+        db.session.expire_all()
+        assert User.query.get(u.id).last_seen == first + timedelta(seconds=5)
+        # a fresh last_seen is not updated again within the throttle window
+        buffer.touch(u, first + timedelta(seconds=30))
+        buffer.flush()
+        db.session.expire_all()
+        assert User.query.get(u.id).last_seen == first + timedelta(seconds=5)
+
+    def test_flusher_restarts_after_fork(self):
+        flusher = Flusher(lambda: None, 3600, at_exit=False)
+        flusher.start()
+        thread = flusher._thread
+        flusher.start()
+        assert flusher._thread is thread
+        # a forked child inherits the attribute, but not the thread
+        with mock.patch('app.background.os.getpid', return_value=-1):
+            flusher.start()
+        assert flusher._thread is not thread
+        assert flusher._thread.is_alive()
+
+    def test_follow_digest(self):
+        followed = User(username='john', email='john@example.com')
+        self.create_user(followed)
+        for i in range(4):
+            self.create_user(User(username='fan%d' % i,
+                                  email='fan%d@example.com' % i))
+        fans = User.query.filter(User.username.like('Fan%')) \
+            .order_by(User.id).all()
+        digest = FollowDigest(3600)
+        for fan in fans:
+            digest.record(followed, fan)
+        digest.record(followed, fans[0])  # counted once
+        with mock.patch('app.emails.mail_dispatcher') as dispatcher:
+            digest.flush()
+        assert dispatcher.submit.call_count == 1
+        msg = dispatcher.submit.call_args[0][0]
+        assert msg.recipients == ['john@example.com']
+        assert msg.subject == \
+            '[microblog] Fan0, Fan1 and 2 others are now following you!'
+        assert 'Fan1' in msg.body and 'Fan2' not in msg.body
+        # one digest failing doesn't lose the others
+        digest.record(followed, fans[1])
+        digest.record(fans[0], fans[1])
+        with mock.patch.object(digest, '_send',
+                               side_effect=[Exception('boom'), None]) as send:
+            digest.flush()
+        assert send.call_count == 2
+
     def test_follow(self):
         u1 = User(username='dog', email='dog@god.com')
         u2 = User(username='cat', email='cat@feedme.com')
@@ -172,6 +511,63 @@ class UserTests(UserTestClass):
         assert u1.followed.count() == 0
         assert u2.followers.count() == 0
 
+    def test_follow_counts(self):
+        u1 = User(username='dog', email='dog@god.com')
+        u2 = User(username='cat', email='cat@feedme.com')
+        self.create_user(u1)
+        self.create_user(u2)
+        self.create_user(u1.follow(u2))
+        assert u1.following_count == 1 and u2.followers_count == 1
+        self.create_user(u1.unfollow(u2))
+        assert u1.following_count == 0 and u2.followers_count == 0
+        # drifted counters are repaired from the followers table
+        u1.follow(u2)
+        u2.followers_count = 42
+        db.session.commit()
+        User.recount_follows()
+        db.session.commit()
+        db.session.expire_all()
+        assert u2.followers_count == 1 and u1.following_count == 1
+        # counts are incremented in SQL, not from the value loaded earlier
+        u3 = User(username='bird', email='bird@sky.com')
+        self.create_user(u3)
+        db.session.execute(User.__table__.update()
+                           .where(User.id == u2.id).values(followers_count=5))
+        u3.follow(u2)
+        db.session.commit()
+        assert u2.followers_count == 6
+
+    def test_is_following_uses_one_query(self):
+        u1 = User(username='dog', email='dog@god.com')
+        users = [User(username='cat%d' % i, email='cat%d@feedme.com' % i)
+                 for i in range(5)]
+        db.session.add(u1)
+        db.session.add_all(users)
+        db.session.commit()
+        db.session.add(u1.follow(users[0]))
+        db.session.add(u1.follow(users[1]))
+        db.session.commit()
+        for u in [u1] + users:
+            db.session.refresh(u)
+        with QueryCounter(db.engine) as counter:
+            following = u1.is_following_many(users)
+            assert all(u1.is_following(u) == following[u.id] for u in users)
+        assert counter.count == 1
+        assert [following[u.id] for u in users] == \
+            [True, True, False, False, False]
+        assert u1.is_following_many([u1]) == {u1.id: False}
+        # following someone new invalidates the cached set
+        u1.follow(users[2])
+        assert u1.is_following(users[2])
+        # the cache shared between requests is bounded
+        shared = LRUCache(1)
+        with mock.patch('app.models.SHARED_FOLLOW_SET_CACHE', True), \
+                mock.patch('app.models.shared_followed_ids', shared):
+            users[3].followed_ids()
+            users[4].followed_ids()
+            assert len(shared) == 1
+            assert shared.get(users[4].id) == frozenset()
+
     def test_follow_posts(self):
         # make four users
         u1 = User(username='john', email='john@example.com')
@@ -225,5 +621,430 @@ class UserTests(UserTestClass):
         assert f3 == [p4, p3]
         assert f4 == [p4]
 
+    def test_timeline_fan_out(self):
+        u1 = User(username='john', email='john@example.com')
+        u2 = User(username='susan', email='susan@example.com')
+        db.session.add(u1)
+        db.session.add(u2)
+        db.session.commit()
+        u1.follow(u1)
+        u1.follow(u2)
+        db.session.commit()
+        # posts written after the follow reach john through fan-out
+        p = Post(body="post from susan", author=u2,
+                 timestamp=datetime.utcnow())
+        db.session.add(p)
+        db.session.flush()
+        p.fan_out()
+        db.session.commit()
+        assert u1.followed_posts().all() == [p]
+        assert u2.followed_posts().all() == []
+        # unfollowing removes susan's posts from john's timeline
+        u1.unfollow(u2)
+        db.session.commit()
+        assert u1.followed_posts().all() == []
+
+    def test_timeline_fan_out_on_read(self):
+        with mock.patch('app.models.TIMELINE_FANOUT_LIMIT', 1):
+            u1 = User(username='john', email='john@example.com')
+            u2 = User(username='susan', email='susan@example.com')
+            db.session.add(u1)
+            db.session.add(u2)
+            db.session.commit()
+            u1.follow(u2)
+            db.session.commit()
+            p = Post(body="post from susan", author=u2,
+                     timestamp=datetime.utcnow())
+            db.session.add(p)
+            db.session.flush()
+            p.fan_out()
+            db.session.commit()
+            # susan is over the limit, so nothing was written on post...
+            assert db.session.query(timeline).count() == 0
+            # ...and her posts are merged in when john reads
+            assert u1.followed_posts().all() == [p]
+            assert paginate(u1.followed_posts(), 2).items == [p]
+            # once susan drops back under the limit her posts are copied
+            # into the timelines of those still following her
+            u3 = User(username='david', email='david@example.com')
+            db.session.add(u3)
+            db.session.commit()
+            u3.follow(u2)
+            db.session.commit()
+        with mock.patch('app.models.TIMELINE_FANOUT_LIMIT', 2):
+            u1.unfollow(u2)
+            db.session.commit()
+            assert not u2.fans_out_on_read()
+            assert db.session.query(timeline).count() == 1
+            assert u3.followed_posts().all() == [p]
+
+    def test_timeline_query_count(self):
+        u = User(username='john', email='john@example.com', password='foobar')
+        self.create_user(u)
+        db.session.add(u.follow(u))
+        db.session.commit()
+        self.login(u, 'john@example.com', 'foobar')
+
+        def add_author(name, seconds):
+            author = User(username=name, email=name + '@example.com')
+            db.session.add(author)
+            db.session.add(Post(body="post from " + name, author=author,
+                                timestamp=datetime.utcnow() +
+                                timedelta(seconds=seconds)))
+            db.session.commit()
+            john = User.query.filter_by(email='john@example.com').first()
+            db.session.add(john.follow(author))
+            db.session.commit()
+
+        def render_profile():
+            # start from an empty identity map, as a real request would
+            db.session.remove()
+            with QueryCounter(db.engine) as counter:
+                rv = self.client.get(url_for('user', username='John'))
+            return rv.data.decode("utf-8"), counter.count
+
+        add_author('susan', 1)
+        page, one_post = render_profile()
+        assert 'post from susan' in page
+        for i, name in enumerate(['mary', 'david', 'jim', 'neo']):
+            add_author(name, i + 2)
+        page, five_posts = render_profile()
+        assert 'post from neo' in page and 'post from susan' in page
+        assert one_post == five_posts
+
+    def test_search_indexing_is_queued(self):
+        reindex(procs=1)  # start from an empty index
+        u = User(username='john', email='john@example.com')
+        p = Post(body="queued for the search index", author=u,
+                 timestamp=datetime.utcnow())
+        db.session.add(u)
+        db.session.add(p)
+        db.session.commit()
+        index_queue.flush()
+        assert p in Post.query.whoosh_search('queued').all()
+        db.session.delete(p)
+        db.session.commit()
+        index_queue.flush()
+        assert Post.query.whoosh_search('queued').all() == []
+
+    def test_search_spill_recovery(self):
+        spill_dir = tempfile.mkdtemp()
+        queue = IndexQueue(os.path.join(spill_dir, 'queue.jsonl'), 100, 1)
+        queue._flusher = mock.Mock()
+        # the spill file of a process that died with changes pending
+        dead = queue.spill_path(999999)
+        with open(dead, 'w') as spill:
+            spill.write('[1, true]\n[2, false]\n[1, false]\n[3, tr')
+        queue.enqueue([(4, True)])
+        queue.recover()
+        assert list(queue._pending.items()) == [(4, True), (2, False),
+                                                (1, False)]
+        assert not os.path.exists(dead)
+        assert queue._flusher.wake.called
+        # ...and this process' own file is left alone
+        queue.recover()
+        assert len(queue._pending) == 3
+        with open(queue.spill_path(os.getpid())) as spill:
+            assert len(spill.readlines()) == 4
+        # a locked index is retried later, not reported as an error
+        with mock.patch.object(queue, '_write', side_effect=LockError):
+            queue.flush()
+        assert len(queue._pending) == 3
+        shutil.rmtree(spill_dir)
+
+    def test_search_result_cache(self):
+        reindex(procs=1)  # start from an empty index
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        for i in range(3):
+            db.session.add(Post(body="cached search %d" % i, author=u,
+                                timestamp=datetime.utcnow()))
+        db.session.commit()
+        index_queue.flush()
+        search_cache.clear()
+        page1 = search_posts('cached', 1, 2)
+        assert len(page1.items) == 2 and page1.has_next
+        assert len(search_cache) == 1
+        # the second page is served from the cached ids
+        with QueryCounter(db.engine) as counter:
+            page2 = search_posts('cached', 2, 2)
+        assert counter.count == 1
+        assert len(page2.items) == 1 and not page2.has_next
+        assert set(page1.items + page2.items) == set(Post.query.all())
+        # indexing a new post moves to a new index generation
+        db.session.add(Post(body="cached search 3", author=u,
+                            timestamp=datetime.utcnow()))
+        db.session.commit()
+        index_queue.flush()
+        assert search_posts('cached', 1, 10).total == 4
+
+    def test_post_fragment_cache(self):
+        u = User(username='john', email='john@example.com')
+        p = Post(body="cached fragment", author=u, timestamp=datetime.utcnow())
+        db.session.add(u)
+        db.session.add(p)
+        db.session.commit()
+        fragments = PostFragments(make_backend('simple'))
+        minute = datetime(2016, 1, 1, 12, 0)
+        with mock.patch('app.fragments.render_template',
+                        return_value='<p>john</p>') as render, \
+                mock.patch('app.fragments.now_bucket', return_value=minute):
+            fragments.render([p])
+            fragments.render([p])
+            assert render.call_count == 1
+            # editing the author's profile retires their cached posts
+            u.username = 'James'
+            assert fragments.render([p]) == [(p, '<p>john</p>')]
+            assert render.call_count == 2
+        # and so does the next time bucket, which moves "said ... ago" on
+        with mock.patch('app.fragments.render_template',
+                        return_value='<p>john</p>') as render, \
+                mock.patch('app.fragments.now_bucket',
+                           return_value=minute + timedelta(minutes=1)):
+            fragments.render([p])
+            assert render.call_count == 1
+
+    def test_conditional_get(self):
+        u = User(username='john', email='john@example.com', password='foobar')
+        self.create_user(u)
+        db.session.add(u.follow(u))
+        db.session.commit()
+        self.login(u, 'john@example.com', 'foobar')
+        url = url_for('user', username='John')
+        rv = self.client.get(url)
+        assert rv.status_code == 200
+        etag = rv.headers['ETag']
+        assert etag.startswith('W/')
+        assert 'Last-Modified' not in rv.headers
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 304
+        assert rv.data == b''
+        # a date alone can't tell whether follows or the profile changed
+        rv = self.client.get(url, headers={
+            'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+        assert rv.status_code == 200
+        # a new post in the timeline changes the version
+        p = Post(body="something new", timestamp=datetime.utcnow(),
+                 author=User.query.filter_by(username='John').first())
+        db.session.add(p)
+        db.session.flush()
+        p.fan_out()
+        db.session.commit()
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+        assert 'something new' in rv.data.decode("utf-8")
+        # and so does a followed author editing their profile
+        susan = User(username='susan', email='susan@example.com')
+        db.session.add(susan)
+        db.session.commit()
+        john = User.query.filter_by(username='John').first()
+        db.session.add(john.follow(susan))
+        db.session.commit()
+        etag = self.client.get(url).headers['ETag']
+        susan.username = 'Suzanne'
+        susan.profile_updated = datetime.utcnow()
+        db.session.commit()
+        rv = self.client.get(url, headers={'If-None-Match': etag})
+        assert rv.status_code == 200
+
+    def test_request_metrics(self):
+        u = User(username='john', email='john@example.com', password='foobar')
+        self.create_user(u)
+        db.session.add(u.follow(u))
+        db.session.commit()
+        self.login(u, 'john@example.com', 'foobar')
+        with mock.patch('app.metrics.SERVER_TIMING', True):
+            rv = self.client.get(url_for('index'))
+        assert rv.status_code == 200
+        assert rv.headers['Server-Timing'].startswith('db;dur=')
+        rv = self.client.get('/_metrics')
+        assert rv.status_code == 200
+        metrics = rv.data.decode('utf-8')
+        assert '# TYPE microblog_sql_queries histogram' in metrics
+        assert 'microblog_request_seconds_bucket{endpoint="index",le="+Inf"}' \
+            in metrics
+        rv = self.client.get('/_metrics',
+                             environ_base={'REMOTE_ADDR': '10.0.0.1'})
+        assert rv.status_code == 404
+
+    def test_api_timeline(self):
+        u = User(username='john', email='john@example.com', password='foobar')
+        db.session.add(u)
+        utcnow = datetime.utcnow()
+        for i in range(3):
+            db.session.add(Post(body="post %d" % i, author=u,
+                                timestamp=utcnow + timedelta(seconds=i)))
+        db.session.commit()
+        db.session.add(u.follow(u))
+        db.session.commit()
+        rv = self.client.get('/api/v1/timeline')
+        assert rv.status_code == 401
+        self.login(u, 'john@example.com', 'foobar')
+        rv = self.client.get('/api/v1/timeline?limit=2&fields=id,body')
+        page = json.loads(rv.data.decode("utf-8"))
+        assert [post['body'] for post in page['posts']] == ['post 2', 'post 1']
+        assert set(page['posts'][0]) == set(['id', 'body'])
+        rv = self.client.get('/api/v1/timeline?limit=2&before=' +
+                             page['before'])
+        page = json.loads(rv.data.decode("utf-8"))
+        assert [post['body'] for post in page['posts']] == ['post 0']
+        assert page['before'] is None
+        rv = self.client.get('/api/v1/users/John/posts?stream=1')
+        assert rv.mimetype == 'application/x-ndjson'
+        lines = rv.data.decode("utf-8").splitlines()
+        assert [json.loads(line)['body'] for line in lines] == \
+            ['post 2', 'post 1', 'post 0']
+        # finished streams give their slot back, extra ones are turned away
+        with mock.patch('app.api.streams', threading.BoundedSemaphore(1)):
+            rv = self.client.get('/api/v1/timeline?stream=1')
+            assert rv.status_code == 200
+            rv.close()
+            rv = self.client.get('/api/v1/timeline?stream=1')
+            assert rv.status_code == 200
+            assert self.client.get('/api/v1/timeline?stream=1') \
+                .status_code == 503
+            rv.close()
+        rv = self.client.get('/api/v1/timeline?fields=password')
+        assert rv.status_code == 400
+
+    def test_live_timeline(self):
+        u1 = User(username='john', email='john@example.com', password='foobar')
+        u2 = User(username='susan', email='susan@example.com')
+        u3 = User(username='mary', email='mary@example.com')
+        db.session.add_all([u1, u2, u3])
+        db.session.commit()
+        db.session.add(u1.follow(u2))
+        db.session.commit()
+        susan, mary = u2.id, u3.id
+        self.login(u1, 'john@example.com', 'foobar')
+        with mock.patch('app.views.LIVE_HEARTBEAT', 0.01):
+            rv = self.client.get(url_for('live'))
+            assert rv.mimetype == 'text/event-stream'
+            events = iter(rv.response)
+            assert next(events).startswith(b'retry:')
+            live_posts.publish(mary, {'id': 1, 'body': 'not followed'})
+            live_posts.publish(susan, {'id': 2, 'body': 'followed'})
+            event = next(events)
+            assert event.startswith(b'id: 2\nevent: post\n')
+            assert b'"followed"' in event
+            assert next(events) == b': keep-alive\n\n'
+            rv.close()
+        # a response that is never read leaves no subscription behind
+        rv = self.client.head(url_for('live'))
+        rv.close()
+        assert susan not in live_posts._subscribers
+
+    def test_sqlite_pragmas(self):
+        assert db.session.execute('PRAGMA journal_mode').scalar() == 'wal'
+        assert db.session.execute('PRAGMA synchronous').scalar() == 1
+        assert db.session.execute('PRAGMA busy_timeout').scalar() == 5000
+
+    def test_replica_reads(self):
+        replica_path = os.path.join(basedir, 'test_replica.db')
+        binds = {'replica': 'sqlite:///' + replica_path}
+        with mock.patch.dict(app.config, {'SQLALCHEMY_BINDS': binds}):
+            db.session.add(User(username='john', email='john@example.com'))
+            db.session.commit()
+            primary = sqlite3.connect(os.path.join(basedir, 'test.db'))
+            replica = sqlite3.connect(replica_path)
+            primary.backup(replica)
+            primary.close()
+            replica.close()
+            db.session.add(User(username='susan', email='susan@example.com'))
+            db.session.commit()
+            db.session.remove()
+            with db.replica_reads():
+                assert User.query.filter_by(username='john').first()
+                assert User.query.filter_by(username='susan').first() is None
+                db.session.add(User(username='david',
+                                    email='david@example.com'))
+                db.session.flush()
+                assert User.query.filter_by(username='susan').first()
+            db.session.rollback()
+            db.session.remove()
+            # Core writes go to the primary too
+            with db.replica_reads():
+                db.session.execute(User.__table__.update()
+                                   .where(User.username == 'john')
+                                   .values(about_me='written'))
+                db.session.commit()
+            primary = sqlite3.connect(os.path.join(basedir, 'test.db'))
+            assert primary.execute(
+                "SELECT about_me FROM user WHERE username = 'john'"
+            ).fetchone() == ('written',)
+            primary.close()
+            db.get_engine(app, bind='replica').dispose()
+        os.remove(replica_path)
+
+    def test_hot_query_indexes(self):
+        def plan(query):
+            compiled = query.statement.compile(dialect=db.engine.dialect)
+            params = tuple(compiled.params[key]
+                           for key in compiled.positiontup)
+            return ' '.join(row[-1] for row in db.engine.execute(
+                'EXPLAIN QUERY PLAN ' + str(compiled), params))
+        assert 'ix_post_user_timestamp' in plan(newest_first(
+            Post.query.filter(Post.user_id == 1)).limit(20))
+        assert 'ix_followers_followed_id' in plan(
+            db.session.query(followers.c.follower_id)
+            .filter(followers.c.followed_id == 1))
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        db.session.commit()
+        part, timestamp, id = keyset_parts(u.followed_posts())[0]
+        page = plan(keyset_range(part, timestamp, id,
+                                 (datetime.utcnow(), 1)).limit(20))
+        assert 'ix_timeline_owner_timestamp_post' in page
+        assert 'SCAN post' not in page
+
+    def test_slow_query_log(self):
+        assert statement_shape("SELECT * FROM post WHERE id IN (?, ?, ?) "
+                               "AND body = 'x' LIMIT 10") == \
+            'SELECT * FROM post WHERE id IN (...) AND body = ? LIMIT ?'
+        path = os.path.join(tempfile.mkdtemp(), 'slow_queries.log')
+        log = SlowQueryLog(0, path, 10)
+        with mock.patch('app.slowquery.slow_query_log', log):
+            for username in ('john', 'susan', 'david'):
+                User.query.filter_by(username=username).first()
+        with open(path) as f:
+            entries = f.read()
+        shutil.rmtree(os.path.dirname(path))
+        assert entries.count('user.username = ?') == 2
+        assert 'parameters: (\'john\',' in entries
+        assert 'USING INDEX ix_user_username' in entries
+        assert 'slow query seen 2 times' in entries
+        assert 'tests.py' in entries
+
+    def test_keyset_pagination(self):
+        u = User(username='john', email='john@example.com')
+        db.session.add(u)
+        utcnow = datetime.utcnow()
+        posts = [Post(body="post %d" % i, author=u,
+                      timestamp=utcnow + timedelta(seconds=i))
+                 for i in range(5)]
+        db.session.add_all(posts)
+        db.session.commit()
+        db.session.add(u.follow(u))
+        db.session.commit()
+        newest_first = list(reversed(posts))
+        page1 = paginate(u.followed_posts(), 2)
+        assert page1.items == newest_first[0:2]
+        assert not page1.has_prev and page1.has_next
+        assert page1.total is None
+        page2 = paginate(u.followed_posts(), 2, before=page1.next_cursor)
+        assert page2.items == newest_first[2:4]
+        assert page2.has_prev and page2.has_next
+        page3 = paginate(u.followed_posts(), 2, before=page2.next_cursor)
+        assert page3.items == newest_first[4:]
+        assert not page3.has_next
+        back = paginate(u.followed_posts(), 2, after=page2.prev_cursor)
+        assert back.items == page1.items
+        assert not back.has_prev
+        counted = paginate(u.followed_posts(), 2, with_total=True)
+        assert counted.total == 5
+        # a tampered cursor falls back to the first page
+        assert paginate(u.followed_posts(), 2,
+                        before='garbage').items == page1.items
+
 if __name__ == '__main__':
     unittest.main()